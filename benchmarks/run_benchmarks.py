@@ -0,0 +1,226 @@
+"""
+Benchmarks of the pipeline stages on synthetic cost surfaces and observations (see synthetic.py). Runs offline.
+
+Run from the repository root:
+    python benchmarks/run_benchmarks.py                   # quick suite, results printed
+    python benchmarks/run_benchmarks.py --save NAME       # store the results in benchmarks/baselines/NAME.json
+    python benchmarks/run_benchmarks.py --compare NAME    # compare the results with a stored baseline
+Each scenario runs in a fresh process, so that imports and peak memory are measured like in a real run.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Cost surface size (cells), NoData fraction, observation years, observations per year and introduction sites
+SCENARIOS = {
+    'small': dict(rows=150, cols=150, nodata_fraction=0.0, years=12, points_per_year=40, introductions=3),
+    'small_nodata': dict(rows=150, cols=150, nodata_fraction=0.25, years=12, points_per_year=40, introductions=3),
+    'medium': dict(rows=400, cols=400, nodata_fraction=0.1, years=20, points_per_year=150, introductions=5),
+    'many_points': dict(rows=400, cols=400, nodata_fraction=0.1, years=20, points_per_year=1000, introductions=10),
+    'large': dict(rows=1500, cols=1500, nodata_fraction=0.1, years=25, points_per_year=400, introductions=10),
+}
+SUITES = {
+    'quick': ['small', 'small_nodata'],
+    'default': ['small', 'small_nodata', 'medium', 'many_points'],
+    'full': list(SCENARIOS),
+}
+START_YEAR = 2000
+THRESHOLD = 0.9  # Quantile threshold for population delineation
+SENSITIVITY_STEPS = np.arange(0.8, 1.0, 0.002)  # Quantile thresholds of the sensitivity test
+
+
+def run_scenario(name, workdir):
+    """
+    Creates the data of the scenario (unless it exists) and runs the pipeline of main.py on it ("all" mode without the
+    optional features, with a sensitivity test over 100 quantile thresholds). Returns the wall and CPU time of each
+    stage and the end-to-end pipeline, the peak memory of the process and some counts of the results, which should only
+    change with the behaviour of the pipeline.
+    """
+    import rasterio as rio
+    from benchmarks.synthetic import cost_surface, observations
+    from src.thinning import thin
+    from src.leastcostpaths import paths
+    from src.populations import statistics, group_paths_save, group_points_save
+    from src.expansionrate import expansion_rate_save
+    from src.sensitivitytest import sensitivity_analysis
+    from src.profiling import profiler, stage, peak_memory_mb
+
+    settings = SCENARIOS[name]
+    os.makedirs(workdir, exist_ok=True)
+    in_tif = os.path.join(workdir, f"{name}_cost.tif")
+    in_gpkg = os.path.join(workdir, f"{name}_points.gpkg")
+    if not (os.path.exists(in_tif) and os.path.exists(in_gpkg)):
+        costs, transform = cost_surface(in_tif, settings['rows'], settings['cols'], settings['nodata_fraction'])
+        observations(in_gpkg, costs, transform, START_YEAR, settings['years'], settings['points_per_year'],
+                     settings['introductions'])
+
+    out_gpkg = os.path.join(workdir, f"{name}_run.gpkg")
+    if os.path.exists(out_gpkg):
+        os.remove(out_gpkg)
+    end_year = START_YEAR + settings['years'] - 1
+
+    profiler.reset()
+    with stage('pipeline'):
+        with rio.open(in_tif) as in_cost:
+            thinned, cell_size = thin(in_gpkg, f"{name}_points", in_cost, out_gpkg, 'points', 'points_thinned',
+                                      'year', START_YEAR, end_year, 'countryCode')
+            lc_paths = paths(out_gpkg, 'paths', thinned, in_cost, 'year', START_YEAR, end_year)
+        statistics(out_gpkg, 'paths')
+        paths_grouped = group_paths_save(out_gpkg, 'paths', 'paths_grouped', THRESHOLD)
+        group_points_save(out_gpkg, 'points', 'paths_grouped', 'points_grouped', cell_size)
+        _, exp_rates = expansion_rate_save(out_gpkg, 'points_grouped', os.path.join(workdir, f"{name}_rates.csv"),
+                                           os.path.join(workdir, f"{name}_cumdist.csv"), 'year', 'countryCode')
+        sensitivity_analysis(out_gpkg, 'points', 'paths', os.path.join(workdir, f"{name}_sensitivity.csv"),
+                             cell_size, 'year', 'countryCode', SENSITIVITY_STEPS, False, np.arange(5, 16, 1))
+
+    # Stages directly within the pipeline, summed over repeated calls
+    stages = {}
+    for record in profiler.take_records():
+        parts = record['stage'].split('/')
+        if parts[0] == 'pipeline' and len(parts) <= 2:
+            stage_times = stages.setdefault(parts[-1], {'wall_s': 0.0, 'cpu_s': 0.0})
+            stage_times['wall_s'] += record['wall_s']
+            stage_times['cpu_s'] += record['cpu_s']
+
+    return {
+        'stages': stages,
+        'peak_memory_mb': peak_memory_mb(),
+        'counts': {
+            'thinned_points': len(thinned),
+            'paths': len(lc_paths),
+            'grouped_paths': len(paths_grouped),
+            'populations': len(exp_rates)
+        }
+    }
+
+
+def run_scenario_process(name, workdir, repeat):
+    """
+    Runs the scenario repeat times, each in a fresh process, and keeps the fastest run of each stage.
+    """
+    result = None
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario-process', name, workdir],
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"Scenario '{name}' failed:\n{process.stderr}")
+        run = json.loads(process.stdout.strip().splitlines()[-1])
+        if result is None:
+            result = run
+            continue
+        for stage_name, stage_times in run['stages'].items():
+            best = result['stages'][stage_name]
+            best['wall_s'] = min(best['wall_s'], stage_times['wall_s'])
+            best['cpu_s'] = min(best['cpu_s'], stage_times['cpu_s'])
+    return result
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def compare(results, baseline, tolerance, min_difference):
+    """
+    Prints the wall times of the results next to those of the baseline. Returns the number of stages which are slower
+    than the baseline by more than the tolerance factor and min_difference seconds (to ignore the noise of very short
+    stages), and warns about changed result counts.
+    """
+    print(f"Baseline: commit {baseline['machine'].get('commit')}, {baseline['machine'].get('platform')}")
+    print(f"{'scenario':<14} {'stage':<22} {'baseline_s':>10} {'current_s':>10} {'ratio':>7}")
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline['scenarios']:
+            print(f"{name:<14} (not in baseline)")
+            continue
+        baseline_result = baseline['scenarios'][name]
+        for stage_name, stage_times in result['stages'].items():
+            baseline_wall = baseline_result['stages'].get(stage_name, {}).get('wall_s')
+            if baseline_wall is None:
+                continue
+            ratio = stage_times['wall_s'] / baseline_wall if baseline_wall > 0 else float('inf')
+            flag = ''
+            if ratio > tolerance and stage_times['wall_s'] - baseline_wall > min_difference:
+                flag = 'SLOWER'
+                regressions += 1
+            elif ratio < 1 / tolerance:
+                flag = 'faster'
+            print(f"{name:<14} {stage_name:<22} {baseline_wall:>10.3f} {stage_times['wall_s']:>10.3f} {ratio:>7.2f} "
+                  f"{flag}")
+        if result['counts'] != baseline_result['counts']:
+            print(f"{name:<14} WARNING: results differ from the baseline: {result['counts']} "
+                  f"(baseline: {baseline_result['counts']})")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'scenario':<14} {'stage':<22} {'wall_s':>8} {'cpu_s':>8}")
+    for name, result in results.items():
+        for stage_name, stage_times in result['stages'].items():
+            print(f"{name:<14} {stage_name:<22} {stage_times['wall_s']:>8.3f} {stage_times['cpu_s']:>8.3f}")
+        print(f"{name:<14} {'peak memory (MB)':<22} {result['peak_memory_mb']:>8.0f}   counts: {result['counts']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the pipeline stages on synthetic data.")
+    parser.add_argument('--suite', choices=list(SUITES), default='quick')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), help="Scenarios to run instead of a suite")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per scenario, the fastest run counts")
+    parser.add_argument('--workdir', help="Directory for the synthetic data and outputs (default: temporary)")
+    parser.add_argument('--save', metavar='NAME', help="Save the results as baseline NAME")
+    parser.add_argument('--compare', metavar='NAME', help="Compare the results with baseline NAME")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help="Factor by which a stage may be slower than the baseline (default: 1.25)")
+    parser.add_argument('--min-difference', type=float, default=0.05,
+                        help="Seconds by which a stage must at least be slower to count as slower (default: 0.05)")
+    parser.add_argument('--scenario-process', nargs=2, metavar=('SCENARIO', 'WORKDIR'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario_process is not None:
+        logging.basicConfig(level='WARNING')
+        print(json.dumps(run_scenario(*args.scenario_process)))
+        return 0
+
+    scenarios = args.scenarios or SUITES[args.suite]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = args.workdir or temp_dir
+        results = {}
+        for name in scenarios:
+            print(f"Running scenario '{name}' {SCENARIOS[name]}...", flush=True)
+            results[name] = run_scenario_process(name, workdir, args.repeat)
+    print_results(results)
+
+    if args.save is not None:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        baseline_path = os.path.join(BASELINE_DIR, f"{args.save}.json")
+        with open(baseline_path, 'w') as f:
+            json.dump({'machine': machine_info(), 'scenarios': results}, f, indent=1)
+        print(f"Baseline saved to '{baseline_path}'.")
+
+    if args.compare is not None:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_difference)
+        if regressions:
+            print(f"{regressions} stage(s) slower than the baseline by more than a factor of {args.tolerance}.")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_origin
+
+# Synthetic data is created in ETRS89-LAEA (metric) around Europe, with the observations stored in WGS 84 like GBIF
+# exports, so that thin() reprojects them
+RASTER_CRS = 'EPSG:3035'
+POINTS_CRS = 'EPSG:4326'
+ORIGIN_X, ORIGIN_Y = 3000000, 3500000
+
+
+def cost_surface(out_tif, rows, cols, nodata_fraction=0.0, cell_size=5000, seed=0):
+    """
+    Writes a synthetic cost surface (float32 GeoTIFF) with a smooth cost landscape plus noise, and circular NoData
+    areas ("lakes") covering about nodata_fraction of the cells.
+    Returns the cost array (NoData cells as NaN) and the transform.
+    """
+    rng = np.random.default_rng(seed)
+    row_index, col_index = np.mgrid[0:rows, 0:cols].astype(np.float32)
+
+    # Smooth landscape: a few random waves, rescaled to costs between 0.1 and 1
+    costs = np.zeros((rows, cols), dtype=np.float32)
+    for _ in range(4):
+        frequency_row, frequency_col = rng.uniform(0.5, 4, size=2) * 2 * np.pi / np.array([rows, cols])
+        costs += np.sin(row_index * frequency_row + rng.uniform(0, 2 * np.pi)) * np.cos(col_index * frequency_col)
+    costs += rng.normal(0, 0.3, size=(rows, cols)).astype(np.float32)
+    costs = 0.1 + 0.9 * (costs - costs.min()) / (costs.max() - costs.min())
+
+    # NoData lakes, added until the fraction is reached
+    is_nodata = np.zeros((rows, cols), dtype=bool)
+    while is_nodata.mean() < nodata_fraction:
+        center_row, center_col = rng.uniform(0, rows), rng.uniform(0, cols)
+        radius = rng.uniform(0.02, 0.08) * min(rows, cols)
+        is_nodata |= (row_index - center_row) ** 2 + (col_index - center_col) ** 2 <= radius ** 2
+    costs[is_nodata] = np.nan
+
+    transform = from_origin(ORIGIN_X, ORIGIN_Y + rows * cell_size, cell_size, cell_size)
+    nodata = -9999.0
+    with rio.open(out_tif, 'w', driver='GTiff', height=rows, width=cols, count=1, dtype='float32', crs=RASTER_CRS,
+                  transform=transform, nodata=nodata) as dst:
+        dst.write(np.where(is_nodata, nodata, costs).astype(np.float32), 1)
+    return costs, transform
+
+
+def observations(out_gpkg, costs, transform, start_year, years, points_per_year, introductions, seed=0):
+    """
+    Writes a synthetic set of spreading observations (point layer named like the file) with the fields 'year' and
+    'countryCode'. In the first year, observations are made at the introduction sites. Every later year, each new
+    observation is made at a random distance from an earlier observation (a new introduction with probability 2%).
+    Observations only fall on cells with a cost value.
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = costs.shape
+    valid_cells = np.flatnonzero(~np.isnan(costs))
+    spread_cells = 0.02 * min(rows, cols)
+
+    def random_cells(n):
+        cells = rng.choice(valid_cells, size=n)
+        return np.column_stack(np.unravel_index(cells, costs.shape)).astype(np.float64)
+
+    # Introduction sites, and the observations of each year around earlier observations
+    coords = random_cells(introductions)
+    point_years = np.full(introductions, start_year)
+    for year in range(start_year + 1, start_year + years):
+        parents = coords[rng.integers(0, len(coords), size=points_per_year)]
+        new_coords = parents + rng.normal(0, spread_cells, size=(points_per_year, 2))
+        is_introduction = rng.random(points_per_year) < 0.02
+        new_coords[is_introduction] = random_cells(is_introduction.sum())
+        rows_new, cols_new = np.floor(new_coords[:, 0]).astype(np.int64), np.floor(new_coords[:, 1]).astype(np.int64)
+        is_inside = (rows_new >= 0) & (rows_new < rows) & (cols_new >= 0) & (cols_new < cols)
+        is_inside[is_inside] = ~np.isnan(costs[rows_new[is_inside], cols_new[is_inside]])
+        coords = np.concatenate([coords, new_coords[is_inside]])
+        point_years = np.concatenate([point_years, np.full(is_inside.sum(), year)])
+
+    # Point coordinates within the cells, and a location code by quadrant of the raster
+    xs, ys = rio.transform.xy(transform, coords[:, 0], coords[:, 1], offset='ul')
+    cell_size = transform.a
+    xs = np.asarray(xs) + (coords[:, 1] % 1) * cell_size
+    ys = np.asarray(ys) - (coords[:, 0] % 1) * cell_size
+    quadrants = np.array(['NW', 'NE', 'SW', 'SE'])
+    locations = quadrants[(coords[:, 0] >= rows / 2) * 2 + (coords[:, 1] >= cols / 2)]
+
+    points = gpd.GeoDataFrame({'year': point_years.astype(np.int32), 'countryCode': locations},
+                              geometry=gpd.points_from_xy(xs, ys), crs=RASTER_CRS).to_crs(POINTS_CRS)
+    layer = os.path.basename(out_gpkg).replace('.gpkg', '')
+    points.to_file(out_gpkg, layer=layer, engine='pyogrio')
+    return points
@@ -2,12 +2,20 @@ import params
 import os
 import rasterio as rio
 import numpy as np
-from datetime import datetime as dt
+import pandas as pd
+import logging
 from src.thinning import thin
-from src.leastcostpaths import paths
-from src.populations import group_paths_save, group_points_save, statistics
+from src.leastcostpaths import paths, last_unchanged_year, add_path_points, spread_edges, cost_window
+from src.populations import group_paths_save, group_points_save, statistics, path_cells
 from src.expansionrate import expansion_rate_save
 from src.sensitivitytest import sensitivity_analysis
+from src.pathcache import PathCache
+from src.layerio import LayerWriter, save_layer, read_layer, write_table, export_layers
+from src.profiling import peak_memory_mb, configure_logging, profiler
+from src.batch import run_batch
+from src.uncertainty import expansion_rate_uncertainty
+
+logger = logging.getLogger(__name__)
 
 # Load parameters
 workdir_path = params.workdir_path
@@ -19,46 +27,171 @@ year_field = params.year_field
 location_field = params.location_field
 start_year = params.start_year
 end_year = params.end_year
+presence_batch_size = getattr(params, 'presence_batch_size', 100000)
 cost_name = params.cost_name
+max_accumulated_cost = getattr(params, 'max_accumulated_cost', None)
+low_memory_cost = getattr(params, 'low_memory_cost', False)
+cost_window_buffer = getattr(params, 'cost_window_buffer', None)
+paths_cache_dir = getattr(params, 'paths_cache_dir', None)
+paths_cache_size_mb = getattr(params, 'paths_cache_size_mb', 1024)
+paths_workers = getattr(params, 'paths_workers', 1)
 mode = params.mode
+previous_run = getattr(params, 'previous_run', None) or run
+workers = getattr(params, 'workers', 1)
+in_memory_pipeline = getattr(params, 'in_memory_pipeline', False)
+output_format = getattr(params, 'output_format', 'gpkg')
+export_gpkg = getattr(params, 'export_gpkg', False)
+log_level = getattr(params, 'log_level', 'INFO')
+run_profile = getattr(params, 'run_profile', None)
+profile_stage = getattr(params, 'profile_stage', None)
+batch_manifest = getattr(params, 'batch_manifest', None)
 acc_cost_test_steps = getattr(params, 'acc_cost_test_steps', None)
 acc_cost_steps_are_absolute = getattr(params, 'acc_cost_steps_are_absolute', None)
+expansion_rate_diagnostics = getattr(params, 'expansion_rate_diagnostics', False)
 robust_test_steps = getattr(params, 'robust_test_steps', None)
+sensitivity_change_points = getattr(params, 'sensitivity_change_points', False)
+uncertainty_replicates = getattr(params, 'uncertainty_replicates', 100)
+uncertainty_method = getattr(params, 'uncertainty_method', 'subsample')
+uncertainty_fraction = getattr(params, 'uncertainty_fraction', 0.8)
+uncertainty_seed = getattr(params, 'uncertainty_seed', 0)
+uncertainty_confidence = getattr(params, 'uncertainty_confidence', 0.95)
 
 # Define dynamic names
 in_gpkg = os.path.join(workdir_path, presence_name)
 in_lyr_points = presence_name.replace(".gpkg", "")
-out_gpkg = os.path.join(workdir_path, f"{run}.gpkg")
+# Layers are stored in a GeoPackage or as GeoParquet files in a directory named after the run (see src/layerio.py)
+layers_ext = ".gpkg" if output_format == "gpkg" else ""
+out_gpkg = os.path.join(workdir_path, f"{run}{layers_ext}")
 out_lyr_points = f"{run}_points"
 out_lyr_points_thinned = f"{run}_points_thinned"
 out_lyr_points_grouped = f"{run}_points_grouped"
 out_lyr_paths = f"{run}_paths"
 out_lyr_paths_grouped = f"{run}_paths_grouped"
-out_csv_sensitivity_test = os.path.join(workdir_path, f"{run}_sensitivity_test.csv")
+out_csv_sensitivity_test = os.path.join(workdir_path, f"{run}_sensitivity_test.{'csv' if output_format == 'gpkg' else 'parquet'}")
+out_csv_sensitivity_intervals = os.path.join(workdir_path, f"{run}_sensitivity_intervals.{'csv' if output_format == 'gpkg' else 'parquet'}")
 out_csv_rates = os.path.join(workdir_path, f"{run}_expansion_rates.csv")
 out_csv_cumdist = os.path.join(workdir_path, f"{run}_cumulative_distances.csv")
+out_rate_replicates = os.path.join(workdir_path, f"{run}_expansion_rate_replicates.{'csv' if output_format == 'gpkg' else 'parquet'}")
+out_rate_uncertainty = os.path.join(workdir_path, f"{run}_expansion_rate_uncertainty.{'csv' if output_format == 'gpkg' else 'parquet'}")
+out_spread_edges = os.path.join(workdir_path, f"{run}_spread_edges.{'npz' if output_format == 'gpkg' else 'parquet'}")
+out_profile = os.path.join(workdir_path, f"{run}_profile.{run_profile}")
+out_cprofile = os.path.join(workdir_path, f"{run}_profile.prof")
+out_batch_summary = os.path.join(workdir_path, f"{run}_batch_summary.csv")
+paths_cache_path = os.path.join(workdir_path, paths_cache_dir) if paths_cache_dir is not None else None
+
+# Layers passed directly from stage to stage in the in-memory pipeline, instead of being read from the GeoPackage
+layers = {}
+
+
+def save_spread_edges(lc_paths):
+    """Save the spread forest of the least-cost paths as an edge list (see spread_edges())"""
+    write_table(spread_edges(lc_paths), out_spread_edges)
+    logger.info(f"Spread edge list saved to '{out_spread_edges}'.")
 
 
 def run_analysis_pipeline():
     """Run the main analysis pipeline (thinning, paths, grouping, expansion rate)"""
-    # Use global variables for threshold values
-    global threshold, threshold_is_absolute
+    writer = LayerWriter() if in_memory_pipeline else None
+    logger.info(f"Loading cost raster from '{os.path.join(workdir_path, cost_name)}'...")
+    paths_cache = PathCache(paths_cache_path, paths_cache_size_mb) if paths_cache_path is not None else None
+    with rio.open(os.path.join(workdir_path, cost_name)) as in_cost:
+        presence_thinned, cell_size, presence = thin(
+            in_gpkg, in_lyr_points, in_cost, out_gpkg, out_lyr_points, out_lyr_points_thinned, year_field, start_year,
+            end_year, location_field, writer, return_points=True, batch_size=presence_batch_size)
+        lc_paths = paths(out_gpkg, out_lyr_paths, presence_thinned, in_cost, year_field, start_year, end_year,
+                         max_accumulated_cost, low_memory_cost, cost_window_buffer, paths_cache,
+                         writer, paths_workers)
+    save_spread_edges(lc_paths)
+
+    if in_memory_pipeline:
+        layers.update(points=presence, paths=lc_paths)
+    return run_population_pipeline(cell_size, writer)
 
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Loading cost raster from '{os.path.join(workdir_path, cost_name)}'...")
+
+def points_cost_window(in_cost, points):
+    """Cost raster window which paths() uses around the given points (see cost_window())"""
+    point_coords = np.column_stack(rio.transform.rowcol(in_cost.transform, points.geometry.x.to_numpy(),
+                                                        points.geometry.y.to_numpy()))
+    return cost_window(in_cost, point_coords, cost_window_buffer).toslices()
+
+
+def run_update_pipeline():
+    """Update a previous run with the observations after its last year (thinning, paths of the new years, grouping,
+    expansion rate)"""
+    previous_gpkg = os.path.join(workdir_path, f"{previous_run}{layers_ext}")
+    logger.info(f"Updating run '{previous_run}' with observations up to {end_year}...")
+    previous_thinned = read_layer(previous_gpkg, f"{previous_run}_points_thinned")
+    previous_paths = read_layer(previous_gpkg, f"{previous_run}_paths")
+
+    logger.info(f"Loading cost raster from '{os.path.join(workdir_path, cost_name)}'...")
+    paths_cache = PathCache(paths_cache_path, paths_cache_size_mb) if paths_cache_path is not None else None
+    writer = LayerWriter() if in_memory_pipeline else None
     with rio.open(os.path.join(workdir_path, cost_name)) as in_cost:
-        presence_thinned, cell_size = thin(in_gpkg, in_lyr_points, in_cost, out_gpkg, out_lyr_points,
-                                           out_lyr_points_thinned, year_field, start_year, end_year, location_field)
-        paths(out_gpkg, out_lyr_paths, presence_thinned, in_cost, year_field, start_year, end_year)
+        presence_thinned, cell_size, presence = thin(
+            in_gpkg, in_lyr_points, in_cost, out_gpkg, out_lyr_points, out_lyr_points_thinned, year_field, start_year,
+            end_year, location_field, writer, return_points=True, batch_size=presence_batch_size)
+
+        # The paths of a year only depend on the thinned points up to that year. Keep the previous paths as long as
+        # these are unchanged and only calculate the paths of the later years.
+        unchanged_year = last_unchanged_year(previous_thinned, presence_thinned, year_field, start_year, end_year)
+        # With a cost raster window, the paths of all years depend on the window around all points. If the new points
+        # extend it, a full run could find cheaper paths for the earlier years as well.
+        if (cost_window_buffer is not None and unchanged_year > start_year
+                and points_cost_window(in_cost, previous_thinned) != points_cost_window(in_cost, presence_thinned)):
+            logger.warning("WARNING: The new observations extend the cost raster window (cost_window_buffer). "
+                           "Calculating the least-cost paths of all years.")
+            unchanged_year = start_year
+        logger.info(f"Keeping the least-cost paths of the previous run up to {unchanged_year}.")
+        new_paths = paths(None, None, presence_thinned, in_cost, year_field, unchanged_year, end_year,
+                          max_accumulated_cost, low_memory_cost, cost_window_buffer, paths_cache,
+                          workers=paths_workers)
+        raster_width = in_cost.width
+
+    all_paths = pd.concat([previous_paths[previous_paths['destination_year'] <= unchanged_year], new_paths],
+                          ignore_index=True)
+    # The point IDs of the previous paths refer to the previous thinned points. Identify the points again by their cells.
+    if path_cells(all_paths) is not None:
+        point_cells = (presence_thinned['raster_row'].to_numpy(dtype=np.int64) * raster_width
+                       + presence_thinned['raster_col'].to_numpy(dtype=np.int64))
+        add_path_points(all_paths, point_cells, presence_thinned[year_field], presence_thinned['point_id'])
+        save_spread_edges(all_paths)
+    else:
+        logger.warning(f"WARNING: The previous paths have no source and destination cells. "
+                       "No spread edge list saved.")
+    save_layer(all_paths, out_gpkg, out_lyr_paths,
+               f"Least-cost paths ({len(new_paths.index)} new paths) saved to '{out_gpkg}', layer '{out_lyr_paths}'.",
+               writer)
+
+    # Grouping and expansion rates are repeated for all populations, as new paths can join existing populations and
+    # a quantile threshold depends on all paths
+    if in_memory_pipeline:
+        layers.update(points=presence, paths=all_paths)
+    return run_population_pipeline(cell_size, writer)
 
-    outlier_quantile, outlier_fence, default_test_steps = statistics(out_gpkg, out_lyr_paths)
+
+def run_population_pipeline(cell_size, writer=None):
+    """Run the population part of the analysis pipeline (grouping, expansion rate). In the in-memory pipeline, the
+    stages get their input from the layers dictionary and the layers are saved with the writer in the background."""
+    # Use global variables for threshold values
+    global threshold, threshold_is_absolute
+
+    outlier_quantile, outlier_fence, default_test_steps = statistics(out_gpkg, out_lyr_paths, layers.get('paths'))
 
     if threshold is None:
         threshold = outlier_quantile
         threshold_is_absolute = False
 
-    group_paths_save(out_gpkg, out_lyr_paths, out_lyr_paths_grouped, threshold, threshold_is_absolute)
-    group_points_save(out_gpkg, out_lyr_points, out_lyr_paths_grouped, out_lyr_points_grouped, cell_size)
-    expansion_rate_save(out_gpkg, out_lyr_points_grouped, out_csv_rates, out_csv_cumdist, year_field, location_field)
+    paths_grouped = group_paths_save(out_gpkg, out_lyr_paths, out_lyr_paths_grouped, threshold,
+                                     threshold_is_absolute, layers.get('paths'), writer)
+    points_grouped = group_points_save(out_gpkg, out_lyr_points, out_lyr_paths_grouped, out_lyr_points_grouped,
+                                       cell_size, layers.get('points'),
+                                       paths_grouped if in_memory_pipeline else None, writer)
+    expansion_rate_save(out_gpkg, out_lyr_points_grouped, out_csv_rates, out_csv_cumdist, year_field, location_field,
+                        expansion_rate_diagnostics, points_grouped if in_memory_pipeline else None)
+
+    # Wait until all layers are saved
+    if writer is not None:
+        writer.close()
 
     return cell_size, default_test_steps
 
@@ -68,39 +201,69 @@ def run_sensitivity_test(cell_size, default_test_steps):
     # Use global variables for step values
     global acc_cost_test_steps, acc_cost_steps_are_absolute, robust_test_steps
 
-    # Use provided test steps if set, otherwise use defaults
-    if acc_cost_test_steps is None:
+    # Use provided test steps if set, otherwise use defaults. With change points, all thresholds at which the
+    # populations change are tested by default.
+    if acc_cost_test_steps is None and not sensitivity_change_points:
         acc_cost_test_steps = default_test_steps
         acc_cost_steps_are_absolute = True
 
     if robust_test_steps is None:
         robust_test_steps = np.arange(5, 16, 1)
 
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Running sensitivity analysis...")
+    logger.info("Running sensitivity analysis...")
     sensitivity_analysis(
         out_gpkg,
         out_lyr_points,
         out_lyr_paths,
-        out_csv_sensitivity_test,
+        out_csv_sensitivity_intervals if sensitivity_change_points else out_csv_sensitivity_test,
         cell_size,
         year_field,
         location_field,
         acc_cost_test_steps,
         acc_cost_steps_are_absolute,
-        robust_test_steps
+        robust_test_steps,
+        workers,
+        layers.get('points'),
+        layers.get('paths'),
+        sensitivity_change_points
     )
 
 
+def run_uncertainty():
+    """Estimate the uncertainty of the expansion rates from resampled replicates"""
+    # Use the threshold of the analysis: the given one, or the upper outlier fence
+    uncertainty_threshold, uncertainty_threshold_is_absolute = threshold, threshold_is_absolute
+    if uncertainty_threshold is None:
+        uncertainty_threshold, _, _ = statistics(out_gpkg, out_lyr_paths)
+        uncertainty_threshold_is_absolute = False
+
+    with rio.open(os.path.join(workdir_path, cost_name)) as in_cost:
+        expansion_rate_uncertainty(out_gpkg, out_lyr_points_grouped, out_lyr_paths, in_cost, out_rate_replicates,
+                                   out_rate_uncertainty, year_field, location_field, start_year, end_year,
+                                   uncertainty_threshold, uncertainty_threshold_is_absolute, uncertainty_replicates,
+                                   uncertainty_method, uncertainty_fraction, uncertainty_seed, uncertainty_confidence,
+                                   max_accumulated_cost, low_memory_cost, cost_window_buffer, workers)
+
+
 # Call functions based on mode
 if __name__ == "__main__":
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Running in '{mode}' mode")
+    configure_logging(log_level)
+    if profile_stage is not None:
+        profiler.enable_cprofile(profile_stage)
+    logger.info(f"Running in '{mode}' mode")
 
-    if mode in ["analysis", "all"]:
-        cell_size, default_test_steps = run_analysis_pipeline()
+    if mode in ["analysis", "all", "update"]:
+        if mode == "update":
+            cell_size, default_test_steps = run_update_pipeline()
+        else:
+            cell_size, default_test_steps = run_analysis_pipeline()
 
         if mode == "all":
             run_sensitivity_test(cell_size, default_test_steps)
 
+        if output_format != "gpkg" and export_gpkg:
+            export_layers(out_gpkg, os.path.join(workdir_path, f"{run}.gpkg"))
+
     elif mode == "test":
         # For test mode, ensure the required files exist
         try:
@@ -112,8 +275,47 @@ if __name__ == "__main__":
 
             run_sensitivity_test(cell_size, default_test_steps)
         except Exception as e:
-            print(f"[{dt.now().strftime('%H:%M:%S')}] ERROR: {e}")
-            print(f"[{dt.now().strftime('%H:%M:%S')}] Did you forget to run in 'analysis' mode to generate least-cost paths?")
+            logger.error(f"ERROR: {e}")
+            logger.error("Did you forget to run in 'analysis' mode to generate least-cost paths?")
+
+    elif mode == "uncertainty":
+        try:
+            run_uncertainty()
+        except FileNotFoundError as e:
+            logger.error(f"ERROR: {e}")
+            logger.error("Did you forget to run in 'analysis' mode to generate the grouped observations and paths?")
+
+    elif mode == "batch":
+        if batch_manifest is None:
+            logger.error("ERROR: No batch manifest set (batch_manifest).")
+        else:
+            # Parameters of this file, used for the settings which a run of the manifest does not give
+            batch_defaults = dict(
+                presence_name=presence_name, cost_name=cost_name, year_field=year_field,
+                location_field=location_field, start_year=start_year, end_year=end_year,
+                presence_batch_size=presence_batch_size, threshold=threshold,
+                threshold_is_absolute=threshold_is_absolute, max_accumulated_cost=max_accumulated_cost,
+                low_memory_cost=low_memory_cost, cost_window_buffer=cost_window_buffer,
+                expansion_rate_diagnostics=expansion_rate_diagnostics, output_format=output_format, mode="analysis",
+                acc_cost_test_steps=acc_cost_test_steps, acc_cost_steps_are_absolute=acc_cost_steps_are_absolute,
+                robust_test_steps=robust_test_steps, sensitivity_change_points=sensitivity_change_points)
+            run_batch(os.path.join(workdir_path, batch_manifest), workdir_path, batch_defaults, out_batch_summary,
+                      workers)
+
+    elif mode == "clear_cache":
+        if paths_cache_path is None:
+            logger.error("ERROR: No path cache set (paths_cache_dir).")
+        else:
+            PathCache(paths_cache_path).clear()
 
     else:
-        print(f"[{dt.now().strftime('%H:%M:%S')}] ERROR: Invalid mode '{mode}'. Valid modes are 'analysis', 'all', or 'test'")
+        logger.error(f"ERROR: Invalid mode '{mode}'. Valid modes are 'analysis', 'all', 'update', 'test', 'batch', "
+                     "'uncertainty' or 'clear_cache'")
+
+    peak_memory = peak_memory_mb()
+    if peak_memory is not None:
+        logger.info(f"Peak memory use of the run: {peak_memory:.0f} MB.")
+    if run_profile is not None:
+        profiler.write(out_profile)
+    if profile_stage is not None:
+        profiler.write_cprofile(out_cprofile)
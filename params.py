@@ -10,12 +10,68 @@ workdir_path = r"C:\Users\Christa\Documents\Git\bioinvasionanalysis\data"
 # Output file names and layers will be prefixed with {run} and existing files/layers with identical name overwritten
 run = "imexicana_20241227_gtopo30exp5km_89"
 
+# PREVIOUS SCRIPT RUN NAME (required for "update" mode)
+# Name of the run to be updated. If not specified, the run named above is updated in place.
+previous_run = None
+
 # EXECUTION MODE
 # Controls which parts of the script are executed:
 # "analysis": Run analysis only, excluding sensitivity test
 # "all": Run analysis and sensitivity test
+# "update": Run analysis like "analysis" mode, but keep the least-cost paths of a previous run (see previous_run) for
+#           all years in which the thinned observations are unchanged, and only calculate the paths of the later years.
+#           Use for annual updates with the same cost surface and least-cost path settings as the previous run.
+#           With cost_window_buffer, the paths of all years are calculated if the new observations extend the window.
 # "test": Run the sensitivity test only. Prerequisite: Run in analysis mode once to calculate least-cost paths.
+# "clear_cache": Remove all entries from the path cache (see paths_cache_dir)
+# "batch": Run "analysis" (or "all") for each run of the batch manifest (see batch_manifest)
+# "uncertainty": Estimate the uncertainty of the expansion rates from resampled replicates (see EXPANSION RATE
+#                UNCERTAINTY). Prerequisite: Run in analysis mode once.
 mode = "analysis"
+
+# BATCH MANIFEST (required for "batch" mode)
+# Name of a CSV file in the work directory with one row per run, e.g. for several species, cost surfaces or thresholds.
+# Column "run" names the run (like run above). The columns presence_name, cost_name, year_field, location_field,
+# start_year, end_year, threshold, threshold_is_absolute, max_accumulated_cost, cost_window_buffer and mode
+# ("analysis" or "all") are optional and override the parameters in this file for the run.
+# Each cost surface is read once for all of its runs, which are distributed to the worker processes (see workers).
+# If all of its runs use cost_window_buffer, each run only reads its window instead.
+# A failed run does not stop the batch, nor does a worker process which dies (e.g. out of memory): only its run fails.
+# The status of each run is saved to {run}_batch_summary.csv.
+batch_manifest = None  # example: "batch.csv"
+
+# PARALLEL PROCESSING
+# Number of worker processes for the steps which can run in parallel (sensitivity test, runs of "batch" mode,
+# replicates of "uncertainty" mode).
+# 1 = no parallel processing
+workers = 1
+
+# IN-MEMORY PIPELINE
+# If True, the analysis stages pass their results on directly instead of reading them back from the GeoPackage, and the
+# layers are saved on a background thread. Recommended for large data sets. Needs more memory.
+in_memory_pipeline = False
+
+# OUTPUT FORMAT
+# "gpkg": Layers are saved to the GeoPackage {run}.gpkg and sensitivity test results to a CSV file.
+# "parquet": Layers are saved as GeoParquet files to the directory {run} and sensitivity test results to a Parquet file.
+#            Much faster to write and read for large data sets. Requires pyarrow.
+output_format = "gpkg"
+# If True, the GeoParquet layers are additionally exported to the GeoPackage {run}.gpkg at the end of the run
+export_gpkg = False
+
+# LOGGING
+# Level of the log messages: "INFO" (progress messages), "WARNING" (warnings and errors only, e.g. for batch runs) or
+# "DEBUG" (additionally the start of each stage with the process ID, e.g. to attach py-spy to a worker process)
+log_level = "INFO"
+
+# RUN PROFILE
+# Wall time, CPU time and peak memory of each stage (e.g. "thin", "paths/propagate" per year,
+# "sensitivity_analysis/step" per threshold step) are saved to {run}_profile.json ("json") or {run}_profile.csv ("csv").
+# None = no run profile. The peak memory of a stage (peak_memory_mb) is only recorded on Linux. process_peak_memory_mb
+# is the peak memory of the process up to the end of the stage.
+run_profile = "json"
+# If set, this stage (e.g. "paths/propagate") runs under cProfile and the statistics are saved to {run}_profile.prof
+profile_stage = None
 # ======================================================================================================================
 
 # ================================================= DATA ===============================================================
@@ -30,12 +86,52 @@ location_field = "countryCode"
 start_year = 1993
 # Last year to be analyzed (usually the latest completed year of observation)
 end_year = 2024
+# Number of rows read at a time. Only the observations within the years and the cost surface extent are kept, so large
+# exports (e.g. from GBIF) can be imported with little memory. Reading in batches requires pyarrow.
+presence_batch_size = 100000
 
 # COST SURFACE
 # Name of the file, expected in GeoTIFF format
 cost_name = "cost_surface_gtopo30_esri102031_5km_exp_rescaled.tif"
 # ======================================================================================================================
 
+# ===================== LEAST-COST PATHS (required for "analysis" and "all" modes) =====================================
+# MAXIMUM ACCUMULATED COST
+# If set, the cost propagation stops at this accumulated cost and observations which cannot be reached within it get
+# no least-cost path ("No path found"). This saves a lot of time in years with sparse spread. Paths above the threshold
+# for population delineation are ignored anyway, but note that the outlier fence, quantile thresholds and the
+# sensitivity test then only consider paths up to this cost.
+max_accumulated_cost = None  # example: 9.5 (e.g. the absolute accumulated cost threshold)
+
+# COST RASTER CACHE
+# If True, the cost surface is converted once to a float32 cache file next to the GeoTIFF ("{cost_name}.float32.npy")
+# and memory-mapped from there. Later runs skip reading the GeoTIFF, and worker processes share the file instead of a
+# copy in shared memory. This does not lower the peak memory use: the cost propagation still holds the accumulated
+# costs, tracebacks and a float64 copy of the cost surface (or window) in memory. Only cost_window_buffer reduces it.
+low_memory_cost = False
+
+# COST RASTER WINDOW
+# If set, only the part of the cost surface within this distance (in units of the cost surface CRS) around the bounding
+# box of the observations is used. Least-cost paths cannot leave this window. The memory use of the cost propagation
+# is a multiple of the window size, so this is the setting to use for cost surfaces which do not fit into memory.
+cost_window_buffer = None  # example: 500000 (500 km for a metric CRS)
+
+# PATH CACHE
+# If set, the least-cost paths of each year are stored in this directory (relative to the work directory) and reused
+# in later runs as long as the cost surface, the thinned observations up to that year and the settings above are
+# unchanged. A run which only adds a year then only calculates the paths of that year.
+# The least recently used entries are removed once the cache exceeds paths_cache_size_mb.
+# Run in "clear_cache" mode to remove all entries.
+paths_cache_dir = None  # example: "paths_cache"
+paths_cache_size_mb = 1024
+
+# PARALLEL YEARS
+# Number of worker processes which calculate the least-cost paths of different years at the same time. The cost surface
+# is shared between them, but each worker needs memory for the accumulated costs of its year (a multiple of the cost
+# surface size). The paths are identical to those of a serial run. 1 = serial
+paths_workers = 1
+# ======================================================================================================================
+
 # ===================== POPULATION DELINEATION (required for "analysis" and "all" modes) ===============================
 # ACCUMULATED COST THRESHOLD
 # To isolate populations, we remove least-cost paths that have an accumulated cost exceeding a specified threshold.
@@ -45,6 +141,13 @@ threshold = 0.89  # example for acc. cost value: 4.4 / for quantile value: 0.95
 threshold_is_absolute = False  # True = acc. cost value, False = quantile value
 # ======================================================================================================================
 
+# ====================== EXPANSION RATE (required for "analysis" and "all" modes) ======================================
+# REGRESSION DIAGNOSTICS
+# If True, an OLS model is fitted per population with statsmodels, which adds the standard error (std_error) and p-value
+# (p_value) of the expansion rate to {run}_expansion_rates.csv. Slower for many populations.
+expansion_rate_diagnostics = False
+# ======================================================================================================================
+
 # ========================== SENSITIVITY TEST (required for "test" and "all" mode) =====================================
 # ACCUMULATED COST THRESHOLD RANGE to be tested.
 # If not specified, the following test step range will be used: np.arange(0.00, max_cost + 0.01, 0.01)
@@ -56,4 +159,31 @@ acc_cost_steps_are_absolute = True
 # The average expansion rate will be calculated across robust populations.
 # If not specified, the following test step range will be used: np.arange(5, 16, 1)
 robust_test_steps = np.arange(5, 16, 1)
+
+# CHANGE POINTS
+# The populations only change at the accumulated costs of the paths. If True, the results are saved once per interval
+# of thresholds with the same populations to {run}_sensitivity_intervals.csv (columns threshold_from (exclusive),
+# threshold_to (inclusive), path_count, quantile and the results) instead of once per test step. This is much smaller
+# for fine test steps. If acc_cost_test_steps is None, all intervals are tested. The table per test step can be
+# recreated with src.sensitivitytest.expand_sensitivity_intervals().
+sensitivity_change_points = False
+# ======================================================================================================================
+
+# ================== EXPANSION RATE UNCERTAINTY (required for "uncertainty" mode) ======================================
+# REPLICATES
+# The observations are resampled for each replicate, and thinning, least-cost paths, grouping and expansion rates are
+# repeated (with the threshold above). Least-cost paths of the run are reused wherever the resampled observations allow,
+# so a replicate is much faster than a run. Each population of the run is compared with the replicate population which
+# shares most of its observations. The expansion rates of all replicates are saved to
+# {run}_expansion_rate_replicates.csv and their mean, standard deviation and confidence interval per population to
+# {run}_expansion_rate_uncertainty.csv.
+uncertainty_replicates = 100
+# "subsample": Each replicate keeps a random fraction (uncertainty_fraction) of the observations
+# "bootstrap": Each replicate draws as many observations as there are, with replacement
+uncertainty_method = "subsample"
+uncertainty_fraction = 0.8
+# Seed of the random generator. The same seed gives the same replicates, regardless of the number of workers.
+uncertainty_seed = 0
+# Confidence level of the (percentile) confidence intervals
+uncertainty_confidence = 0.95
 # ======================================================================================================================
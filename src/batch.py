@@ -0,0 +1,280 @@
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from src.thinning import thin
+from src.leastcostpaths import paths, read_cost_array, share_cost_array, attach_cost_array, spread_edges
+from src.populations import statistics, group_paths_save, group_points_save
+from src.expansionrate import expansion_rate_save
+from src.sensitivitytest import sensitivity_analysis
+from src.layerio import write_table
+from src.profiling import profiler, stage
+
+logger = logging.getLogger(__name__)
+
+# Settings which can be given per run in the manifest, in addition to the run name. Missing or empty values are taken
+# from the defaults (params.py).
+RUN_SETTINGS = {
+    'presence_name': str,
+    'cost_name': str,
+    'year_field': str,
+    'location_field': str,
+    'start_year': int,
+    'end_year': int,
+    'threshold': float,
+    'threshold_is_absolute': bool,
+    'max_accumulated_cost': float,
+    'cost_window_buffer': float,
+    'mode': str
+}
+
+# Modes of main.py which a run of the manifest can use
+RUN_MODES = ('analysis', 'all')
+
+
+def _parse_value(value, setting_type):
+    if setting_type is bool and isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return setting_type(value)
+
+
+def read_manifest(in_manifest, defaults):
+    """
+    Reads the runs of a batch from a CSV manifest with one row per run: a 'run' column (name of the run, used for the
+    output files like in main.py) and any of the columns in RUN_SETTINGS. Returns the settings of each run, with the
+    defaults for the settings which the manifest does not give. The mode of a run must be one of RUN_MODES. An invalid
+    manifest raises a ValueError before any run is started.
+    """
+    manifest = pd.read_csv(in_manifest, dtype=str, keep_default_na=False)
+    if 'run' not in manifest.columns:
+        raise ValueError(f"The batch manifest '{in_manifest}' has no 'run' column.")
+    unknown = [column for column in manifest.columns if column != 'run' and column not in RUN_SETTINGS]
+    if unknown:
+        raise ValueError(f"Unknown columns in the batch manifest '{in_manifest}': {', '.join(unknown)}.")
+    duplicated = manifest['run'][manifest['run'].duplicated()].unique()
+    if len(duplicated):
+        raise ValueError(f"Duplicate run names in the batch manifest '{in_manifest}': {', '.join(duplicated)}.")
+
+    runs = []
+    for row in manifest.to_dict('records'):
+        settings = dict(defaults, run=row.pop('run'))
+        for setting, value in row.items():
+            if value.strip() == '':
+                continue
+            try:
+                settings[setting] = _parse_value(value, RUN_SETTINGS[setting])
+            except ValueError:
+                raise ValueError(f"Invalid value '{value}' of {setting} for run '{settings['run']}' in the batch "
+                                 f"manifest '{in_manifest}'.") from None
+        if settings['mode'] not in RUN_MODES:
+            raise ValueError(f"Invalid mode '{settings['mode']}' for run '{settings['run']}' in the batch manifest "
+                             f"'{in_manifest}'. Valid modes are 'analysis' or 'all'.")
+        runs.append(settings)
+    return runs
+
+
+def run_analysis(settings, workdir, in_cost, cost_array=None):
+    """
+    Runs the analysis pipeline of main.py ("analysis" mode, or "all" mode with the sensitivity test) for the settings
+    of one run, with the given opened cost raster and the cost array read from it, if any. Returns some counts of the
+    results.
+    """
+    run = settings['run']
+    year_field, location_field = settings['year_field'], settings['location_field']
+    start_year, end_year = settings['start_year'], settings['end_year']
+    is_gpkg = settings['output_format'] == 'gpkg'
+    layers_ext = ".gpkg" if is_gpkg else ""
+    out_gpkg = os.path.join(workdir, f"{run}{layers_ext}")
+    in_gpkg = os.path.join(workdir, settings['presence_name'])
+
+    thinned, cell_size = thin(in_gpkg, settings['presence_name'].replace(".gpkg", ""), in_cost, out_gpkg,
+                              f"{run}_points", f"{run}_points_thinned", year_field, start_year, end_year,
+                              location_field, batch_size=settings['presence_batch_size'])
+    lc_paths = paths(out_gpkg, f"{run}_paths", thinned, in_cost, year_field, start_year, end_year,
+                     settings['max_accumulated_cost'], settings['low_memory_cost'], settings['cost_window_buffer'],
+                     cost_array=cost_array)
+    write_table(spread_edges(lc_paths),
+                os.path.join(workdir, f"{run}_spread_edges.{'npz' if is_gpkg else 'parquet'}"))
+
+    outlier_quantile, _, default_test_steps = statistics(out_gpkg, f"{run}_paths")
+    threshold, threshold_is_absolute = settings['threshold'], settings['threshold_is_absolute']
+    if threshold is None:
+        threshold, threshold_is_absolute = outlier_quantile, False
+    paths_grouped = group_paths_save(out_gpkg, f"{run}_paths", f"{run}_paths_grouped", threshold,
+                                     threshold_is_absolute)
+    group_points_save(out_gpkg, f"{run}_points", f"{run}_paths_grouped", f"{run}_points_grouped", cell_size)
+    _, exp_rates = expansion_rate_save(out_gpkg, f"{run}_points_grouped",
+                                       os.path.join(workdir, f"{run}_expansion_rates.csv"),
+                                       os.path.join(workdir, f"{run}_cumulative_distances.csv"),
+                                       year_field, location_field, settings['expansion_rate_diagnostics'])
+
+    if settings['mode'] == 'all':
+        test_steps, steps_are_absolute = settings['acc_cost_test_steps'], settings['acc_cost_steps_are_absolute']
+        change_points = settings['sensitivity_change_points']
+        if test_steps is None and not change_points:
+            test_steps, steps_are_absolute = default_test_steps, True
+        robust_steps = settings['robust_test_steps']
+        out_name = f"{run}_sensitivity_{'intervals' if change_points else 'test'}.{'csv' if is_gpkg else 'parquet'}"
+        sensitivity_analysis(out_gpkg, f"{run}_points", f"{run}_paths", os.path.join(workdir, out_name), cell_size,
+                             year_field, location_field, test_steps, steps_are_absolute,
+                             np.arange(5, 16, 1) if robust_steps is None else robust_steps,
+                             change_points=change_points)
+
+    return {'thinned_points': len(thinned), 'paths': len(lc_paths), 'grouped_paths': len(paths_grouped),
+            'populations': len(exp_rates)}
+
+
+def run_isolated(settings, workdir, in_cost, cost_array=None):
+    """
+    Runs run_analysis() and returns a row of the summary table. An error only fails this run: it is logged and
+    recorded in the row.
+    """
+    start = time.perf_counter()
+    logger.info(f"Starting run '{settings['run']}'...")
+    try:
+        with stage('batch_run', run=settings['run']):
+            counts = run_analysis(settings, workdir, in_cost, cost_array)
+        status, error = 'ok', None
+    except Exception as e:
+        counts = {}
+        status, error = 'failed', f"{type(e).__name__}: {e}"
+        logger.error(f"ERROR: Run '{settings['run']}' failed.\n{traceback.format_exc()}")
+    return {'run': settings['run'], 'status': status, 'error': error, 'cost_name': settings['cost_name'],
+            'duration_s': round(time.perf_counter() - start, 3), **counts}
+
+
+def _failed_row(settings, error, duration_s=None):
+    """Row of the summary table of a run which failed outside of run_isolated()"""
+    return {'run': settings['run'], 'status': 'failed', 'error': f"{type(error).__name__}: {error}",
+            'cost_name': settings['cost_name'], 'duration_s': duration_s}
+
+
+def open_cost(cost_path, cost_runs, low_memory=False):
+    """
+    Opens the cost raster of the given runs. The whole cost raster is only read (see read_cost_array()) if one of the
+    runs has no cost_window_buffer. Runs with a cost_window_buffer read their window themselves otherwise.
+    Returns the opened cost raster and the cost array, or None.
+    """
+    in_cost = rio.open(cost_path)
+    try:
+        if all(settings['cost_window_buffer'] is not None for settings in cost_runs):
+            return in_cost, None
+        logger.info(f"Loading cost raster from '{cost_path}' for {len(cost_runs)} runs...")
+        return in_cost, read_cost_array(in_cost, low_memory)
+    except Exception:
+        in_cost.close()
+        raise
+
+
+# Opened cost raster and shared cost array of a worker process, attached once by _init_batch_worker()
+_worker_cost = {}
+
+
+def _init_batch_worker(cost_path, reference):
+    profiler.reset()
+    _worker_cost['dataset'] = rio.open(cost_path)
+    _worker_cost['array'], _worker_cost['shared'] = (None, None) if reference is None else attach_cost_array(reference)
+
+
+def _run_isolated_worker(settings, workdir):
+    row = run_isolated(settings, workdir, _worker_cost['dataset'], _worker_cost['array'])
+    return row, profiler.take_records()
+
+
+def _run_on_pool(runs, workdir, cost_path, reference, workers):
+    """
+    Runs the given runs (position, settings) on a pool of worker processes. Returns the rows of the summary table of
+    the finished runs by position, the runs which are unfinished because a worker process died (e.g. it ran out of
+    memory), which breaks the pool, and the error of the broken pool.
+    """
+    rows, unfinished, pool_error = {}, [], None
+    with ProcessPoolExecutor(max_workers=min(workers, len(runs)), initializer=_init_batch_worker,
+                             initargs=(cost_path, reference)) as executor:
+        futures = [executor.submit(_run_isolated_worker, settings, workdir) for _, settings in runs]
+        for (position, settings), future in zip(runs, futures):
+            try:
+                rows[position], records = future.result()
+            except BrokenProcessPool as e:
+                unfinished.append((position, settings))
+                pool_error = e
+                continue
+            except Exception as e:
+                # The result of the run could not be passed back from the worker process
+                logger.error(f"ERROR: Run '{settings['run']}' failed: {e}")
+                rows[position] = _failed_row(settings, e)
+                continue
+            profiler.add_records(records)
+    return rows, unfinished, pool_error
+
+
+def run_batch(in_manifest, workdir, defaults, out_summary, workers=1):
+    """
+    Runs all runs of a batch manifest (see read_manifest()) and saves a summary table with the status, error, duration
+    and result counts of each run. The runs are processed by cost raster: each cost raster is read once and shared by
+    its runs, unless all of them use a cost_window_buffer (see open_cost()). With workers > 1, the runs of a cost raster
+    are distributed to a pool of worker processes, which attach to the shared cost array (see share_cost_array()) and
+    keep their imports for all of their runs.
+    A failed run does not stop the batch. If a worker process dies (e.g. it runs out of memory), the pool breaks and all
+    of its unfinished runs are run again, each in a worker process of its own. Only the run whose worker process died
+    then fails. Returns the summary table.
+    """
+    runs = read_manifest(in_manifest, defaults)
+    logger.info(f"Running a batch of {len(runs)} runs from '{in_manifest}'...")
+
+    summary = []
+    for cost_name in dict.fromkeys(settings['cost_name'] for settings in runs):
+        cost_runs = [settings for settings in runs if settings['cost_name'] == cost_name]
+        cost_path = os.path.join(workdir, cost_name)
+        low_memory = defaults['low_memory_cost']
+        try:
+            in_cost, cost_array = open_cost(cost_path, cost_runs, low_memory)
+        except Exception as e:
+            logger.error(f"ERROR: Cost raster '{cost_path}' cannot be read: {e}")
+            summary += [_failed_row(settings, e, 0.0) for settings in cost_runs]
+            continue
+
+        with in_cost:
+            if workers <= 1 or len(cost_runs) == 1:
+                summary += [run_isolated(settings, workdir, in_cost, cost_array) for settings in cost_runs]
+                continue
+
+            reference, shared = None, None
+            if cost_array is not None:
+                reference, shared = share_cost_array(cost_array,
+                                                     f"{in_cost.name}.float32.npy" if low_memory else None)
+                del cost_array
+            try:
+                rows, unfinished, pool_error = _run_on_pool(list(enumerate(cost_runs)), workdir, cost_path, reference,
+                                                            workers)
+                if unfinished:
+                    logger.warning(f"WARNING: A worker process died ({pool_error}). Running the {len(unfinished)} "
+                                   f"unfinished runs again, each in a worker process of its own...")
+                for position, settings in unfinished:
+                    start = time.perf_counter()
+                    run_rows, crashed, pool_error = _run_on_pool([(position, settings)], workdir, cost_path,
+                                                                 reference, 1)
+                    rows.update(run_rows)
+                    if crashed:
+                        # The run was alone in the pool, so its own worker process died
+                        logger.error(f"ERROR: Run '{settings['run']}' failed: its worker process died ({pool_error}).")
+                        rows[position] = _failed_row(settings, pool_error, round(time.perf_counter() - start, 3))
+                summary += [rows[position] for position in sorted(rows)]
+            finally:
+                if shared is not None:
+                    shared.close()
+                    shared.unlink()
+
+    summary = pd.DataFrame(summary)
+    # Counts of failed runs are missing
+    summary = summary.astype({column: 'Int64' for column in summary.columns
+                              if column in ('thinned_points', 'paths', 'grouped_paths', 'populations')})
+    write_table(summary, out_summary)
+    failed = (summary['status'] != 'ok').sum()
+    logger.info(f"Batch finished: {len(summary) - failed} runs succeeded, {failed} failed. "
+                f"Summary saved to '{out_summary}'.")
+    return summary
@@ -1,90 +1,142 @@
-from datetime import datetime as dt
+import logging
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import statsmodels.api as sm
-from shapely.geometry import MultiPoint
+from src.layerio import read_layer
+from src.profiling import profiled
 
+logger = logging.getLogger(__name__)
 
-def expansion_rate(in_points, year_field, location_field):
+
+def expansion_rate(in_points, year_field, location_field, diagnostics=False):
     """
     Calculates the expansion rate for each population by regressing cumulative distance to the first point against time.
+    The regressions of all populations are calculated at once from grouped sums. With diagnostics=True, an OLS model is
+    fitted per population with statsmodels instead, adding standard error and p-value of the expansion rate.
+    The reference points and distances are calculated for all populations at once, but the points are still sorted by
+    year per population (one argsort each), so the number of arrays grows with the number of populations. The order of
+    the points within a year sets their cumulative maximum distance, and the rates keep the order of the non-stable
+    quicksort per population of the original DataFrame.sort_values(). One stable lexsort would pin the order, but
+    changes the rates of populations with several observations in a year. The order of such points, and so their rates,
+    can therefore still differ between NumPy versions and CPUs.
     """
     gdf_points = in_points.dropna(subset=[year_field, 'geometry', 'group_id']).astype({year_field: 'int32', 'group_id': 'string'})
-    exp_rates = []
-    cum_distances = []
-
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Calculating expansion rates for groups (populations)...")
-    for group_id, population in gdf_points.groupby('group_id'):
-        # Identify the point(s) from the first year
-        first_year = population[year_field].min()
-        first_year_points = population[population[year_field] == first_year]
-        first_year_geoms = first_year_points.geometry
-
-        # If multiple points, aggregate to a single reference point
-        if len(first_year_geoms) > 1:
-            reference_point = MultiPoint(first_year_geoms.geometry.tolist()).centroid
-        else:
-            reference_point = first_year_geoms.iloc[0]
-
-        # Calculate distances to the reference point
-        population['distance_to_first'] = population.geometry.distance(reference_point)
-
-        # Compute the cumulative maximum distance per year
-        population = population.sort_values(by=year_field)
-        population['cumulative_max_distance'] = population['distance_to_first'].cummax()
-
-        # Append result to list
-        for year, subset in population.groupby(year_field):
-            cum_distances.append({
-                'group_id': group_id,
-                'year': year,
-                'max_distance': subset['cumulative_max_distance'].max()
-            })
-
-        # Calculate stats
-        # Fill years without observations with 0 values for the median calculation
-        min_year = population[year_field].min()
-        max_year = population[year_field].max()
-        all_years = pd.Series(range(min_year, max_year + 1), name=year_field)
-        annual_counts = population.groupby(year_field).size().reindex(all_years, fill_value=0)
-        median_annual_count = annual_counts.median()
-        first_observed_in = " / ".join(first_year_points[location_field].unique())
-
-        # Regression
-        x = sm.add_constant(population[year_field])
-        y = population['cumulative_max_distance']
-        model = sm.OLS(y, x).fit()
-
-        # Append result to list
-        exp_rates.append({
-            'group_id': group_id,
-            'first_observed_in': first_observed_in,
-            'min_year': min_year,
-            'max_year': max_year,
-            'point_count': len(population),
-            'median_points_per_year': median_annual_count,
-            'expansion_rate': model.params.iloc[1],  # Slope of the regression line
-            'r2': model.rsquared  # Model strength (coefficient of determination)
-        })
-
-    return pd.DataFrame(cum_distances).astype({'group_id': 'string'}), pd.DataFrame(exp_rates).astype({'group_id': 'string'})
-
-
-def expansion_rate_save(in_gpkg, in_points, out_csv_rates, out_csv_rates_details, year_field, location_field):
+
+    logger.info("Calculating expansion rates for groups (populations)...")
+    # Group codes in sorted order of group_id, and the points grouped by population (in original order per group)
+    codes, group_ids = pd.factorize(gdf_points['group_id'], sort=True)
+    n_groups = len(group_ids)
+    years = gdf_points[year_field].to_numpy()
+    by_group = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[by_group], np.arange(n_groups + 1))
+    x_coords, y_coords = gdf_points.geometry.x.to_numpy(), gdf_points.geometry.y.to_numpy()
+    min_year = pd.Series(years).groupby(codes).min().to_numpy()
+
+    # Calculate distances to the reference point of each population: the point from the first year, or the centroid of
+    # the points from the first year if there are multiple
+    is_first_year = years == min_year[codes]
+    first_codes = codes[is_first_year]
+    first_year_count = np.bincount(first_codes, minlength=n_groups)
+    reference_x = np.bincount(first_codes, weights=x_coords[is_first_year], minlength=n_groups) / first_year_count
+    reference_y = np.bincount(first_codes, weights=y_coords[is_first_year], minlength=n_groups) / first_year_count
+    dx, dy = x_coords - reference_x[codes], y_coords - reference_y[codes]
+    distances = np.sqrt(dx * dx + dy * dy)
+
+    # Sort the points of each population by year. The order within a year determines the cumulative maximum of each
+    # point, so each population is sorted on its own with the same (non-stable) algorithm as DataFrame.sort_values().
+    order = np.concatenate([by_group[start:end][np.argsort(years[by_group[start:end]], kind='quicksort')]
+                            for start, end in zip(bounds[:-1], bounds[1:])] + [np.empty(0, dtype=np.int64)])
+    codes_sorted, years_sorted = codes[order], years[order]
+
+    # Compute the cumulative maximum distance per population
+    cum_max_distances = pd.Series(distances[order]).groupby(codes_sorted).cummax().to_numpy()
+
+    # Cumulative maximum distance at the end of each year (the maximum, as it never decreases within a population)
+    cum_distances = pd.DataFrame({'code': codes_sorted, 'year': years_sorted.astype(np.int64),
+                                  'max_distance': cum_max_distances})
+    cum_distances = cum_distances.groupby(['code', 'year'], sort=True, as_index=False)['max_distance'].max()
+    cum_distances.insert(0, 'group_id', group_ids[cum_distances.pop('code')])
+
+    # Calculate stats
+    point_count = np.bincount(codes, minlength=n_groups)
+    max_year = pd.Series(years).groupby(codes).max().to_numpy()
+
+    # Median annual observation count. Years without observations count as 0: the first (span - observed years)
+    # elements of the sorted annual counts of a population are 0, followed by the counts of observed years.
+    annual_counts = pd.DataFrame({'code': codes, 'year': years}).value_counts().reset_index(name='count')
+    annual_counts = annual_counts.sort_values(['code', 'count'], kind='stable')
+    observed_years = np.bincount(annual_counts['code'], minlength=n_groups)
+    counts_start = np.concatenate([[0], np.cumsum(observed_years)[:-1]])
+    span = max_year.astype(np.int64) - min_year + 1
+    zero_years = span - observed_years
+    sorted_counts = annual_counts['count'].to_numpy()
+
+    def nth_count(n):
+        return np.where(n < zero_years, 0, sorted_counts[counts_start + np.maximum(n - zero_years, 0)])
+
+    median_annual_count = (nth_count((span - 1) // 2) + nth_count(span // 2)) / 2
+
+    # Locations of the first-year points, in order of appearance
+    first_locations = pd.DataFrame({'code': codes[is_first_year],
+                                    'location': gdf_points[location_field].to_numpy()[is_first_year]})
+    first_observed_in = first_locations.drop_duplicates().groupby('code')['location'].agg(" / ".join)
+
+    # Regression of cumulative maximum distance against year (with intercept), from grouped sums of the centered values
+    x = years_sorted.astype(np.float64)
+    y = cum_max_distances
+    n = point_count[codes_sorted]
+    x_centered = x - (np.bincount(codes_sorted, weights=x, minlength=n_groups) / point_count)[codes_sorted]
+    y_centered = y - (np.bincount(codes_sorted, weights=y, minlength=n_groups) / point_count)[codes_sorted]
+    sxx = np.bincount(codes_sorted, weights=x_centered * x_centered, minlength=n_groups)
+    sxy = np.bincount(codes_sorted, weights=x_centered * y_centered, minlength=n_groups)
+    syy = np.bincount(codes_sorted, weights=y_centered * y_centered, minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx
+        r2 = sxy * sxy / (sxx * syy)
+
+    exp_rates = pd.DataFrame({
+        'group_id': group_ids,
+        'first_observed_in': first_observed_in.reindex(range(n_groups)).to_numpy(),
+        'min_year': min_year,
+        'max_year': max_year,
+        'point_count': point_count.astype(np.int64),
+        'median_points_per_year': median_annual_count.astype(np.float64),
+        'expansion_rate': slope,  # Slope of the regression line
+        'r2': r2  # Model strength (coefficient of determination)
+    })
+
+    if diagnostics:
+        # Full OLS models per population (statsmodels is only needed here). Populations observed in a single year have
+        # no regression line and keep NaN, as above.
+        import statsmodels.api as sm
+        diagnostics_values = np.full((n_groups, 4), np.nan)
+        for code, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if min_year[code] == max_year[code]:
+                continue
+            model = sm.OLS(y[start:end], sm.add_constant(x[start:end])).fit()
+            diagnostics_values[code] = model.params[1], model.rsquared, model.bse[1], model.pvalues[1]
+        for column, values in zip(['expansion_rate', 'r2', 'std_error', 'p_value'], diagnostics_values.T):
+            exp_rates[column] = values
+
+    return cum_distances.astype({'group_id': 'string'}), exp_rates.astype({'group_id': 'string'})
+
+
+@profiled('expansion_rate')
+def expansion_rate_save(in_gpkg, in_points, out_csv_rates, out_csv_rates_details, year_field, location_field, diagnostics=False, points=None):
     """
     Reads from and writes to GeoPackage, wrapping the expansion_rate() function.
+    The points are read from the GeoPackage unless given as a GeoDataFrame.
     """
-    gdf_points = gpd.read_file(in_gpkg, layer=in_points)
+    gdf_points = read_layer(in_gpkg, in_points) if points is None else points
 
-    cum_distances, exp_rates = expansion_rate(gdf_points, year_field, location_field)
+    cum_distances, exp_rates = expansion_rate(gdf_points, year_field, location_field, diagnostics)
 
     # Save cumulative max. distance results
     cum_distances.to_csv(out_csv_rates_details, index=False)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Raw data saved to '{out_csv_rates_details}'.")
+    logger.info(f"Raw data saved to '{out_csv_rates_details}'.")
 
     # Save regression results
     exp_rates.to_csv(out_csv_rates, index=False)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Expansion rates saved to '{out_csv_rates}'.")
+    logger.info(f"Expansion rates saved to '{out_csv_rates}'.")
 
     # Return dataframes (currently only needed for the usage in Jupyter notebook)
     return cum_distances, exp_rates
@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import logging
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
+# Layers are written through Arrow if pyarrow is installed, which is much faster for large layers
+use_arrow = importlib.util.find_spec('pyarrow') is not None
+
+
+def is_geopackage(path):
+    """
+    Layers are stored in a GeoPackage if the path ends with '.gpkg', and as GeoParquet files ('<layer>.parquet') in a
+    directory otherwise.
+    """
+    return path.lower().endswith('.gpkg')
+
+
+@profiled('read_layer')
+def read_layer(in_path, in_layer, columns=None, read_geometry=True):
+    """
+    Reads a layer from a GeoPackage or GeoParquet directory (see is_geopackage()). Only the given columns are read, if
+    any. Columns which the layer does not have are ignored. With read_geometry=False, a DataFrame without geometry is
+    returned.
+    """
+    if is_geopackage(in_path):
+        return gpd.read_file(in_path, layer=in_layer, engine='pyogrio', columns=columns, read_geometry=read_geometry)
+    parquet_path = os.path.join(in_path, f"{in_layer}.parquet")
+    if columns is not None:
+        import pyarrow.parquet as pq
+        layer_columns = pq.read_schema(parquet_path).names
+        columns = [column for column in columns if column in layer_columns]
+    if not read_geometry:
+        return pd.read_parquet(parquet_path, columns=columns)
+    return gpd.read_parquet(parquet_path, columns=None if columns is None else list(columns) + ['geometry'])
+
+
+@profiled('write_layer')
+def write_layer(gdf, out_path, out_layer, message=None):
+    """
+    Writes a GeoDataFrame to a GeoPackage layer (in bulk with the pyogrio engine) or a GeoParquet file, see
+    is_geopackage(), and prints the message, if any.
+    """
+    if is_geopackage(out_path):
+        gdf.to_file(out_path, layer=out_layer, engine='pyogrio', use_arrow=use_arrow)
+    else:
+        os.makedirs(out_path, exist_ok=True)
+        gdf.to_parquet(os.path.join(out_path, f"{out_layer}.parquet"), index=False)
+    if message is not None:
+        logger.info(f"{message}")
+
+
+@profiled('write_table')
+def write_table(df, out_path):
+    """
+    Writes a table to Parquet if the path ends with '.parquet', to NumPy arrays (one per column, see np.savez) if it ends
+    with '.npz', and to CSV otherwise.
+    """
+    if out_path.lower().endswith('.parquet'):
+        df.to_parquet(out_path, index=False)
+    elif out_path.lower().endswith('.npz'):
+        np.savez(out_path, **{column: df[column].to_numpy() for column in df.columns})
+    else:
+        df.to_csv(out_path, index=False)
+
+
+def read_table(in_path):
+    """
+    Reads a table written with write_table().
+    """
+    if in_path.lower().endswith('.parquet'):
+        return pd.read_parquet(in_path)
+    if in_path.lower().endswith('.npz'):
+        with np.load(in_path) as arrays:
+            return pd.DataFrame({column: arrays[column] for column in arrays.files})
+    return pd.read_csv(in_path)
+
+
+def export_layers(in_path, out_gpkg):
+    """
+    Exports all layers of a GeoParquet directory to a GeoPackage.
+    """
+    for file_name in sorted(os.listdir(in_path)):
+        if file_name.endswith('.parquet'):
+            layer = file_name[:-len('.parquet')]
+            write_layer(read_layer(in_path, layer), out_gpkg, layer)
+    logger.info(f"Layers exported to '{out_gpkg}'.")
+
+
+class LayerWriter:
+    """
+    Writes layers on a background thread, one after another in the order they are submitted, so that the pipeline
+    does not wait for the GeoPackage (SQLite) serialisation. The submitted GeoDataFrames must not be modified anymore.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def write(self, gdf, out_path, out_layer, message=None):
+        self.futures.append(self.executor.submit(write_layer, gdf, out_path, out_layer, message))
+
+    def close(self):
+        """
+        Waits until all layers are written. Raises the first error of a write, if any.
+        """
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+
+def save_layer(gdf, out_path, out_layer, message=None, writer=None):
+    """
+    Writes a layer with the given LayerWriter, or right away if there is none.
+    """
+    if writer is None:
+        write_layer(gdf, out_path, out_layer, message)
+    else:
+        writer.write(gdf, out_path, out_layer, message)
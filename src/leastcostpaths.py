@@ -1,82 +1,447 @@
-from datetime import datetime as dt
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 import rasterio as rio
+import shapely
+from rasterio.windows import Window
 from skimage.graph import MCP_Geometric
-from shapely.geometry import LineString, MultiLineString
+from src.layerio import save_layer
+from src.pathcache import file_hash
+from src.profiling import peak_memory_mb, profiled, profiler, stage
 
+logger = logging.getLogger(__name__)
 
-def paths(out_gpkg, out_paths, in_points, in_cost, year_field, start_year, end_year):
+
+class BoundedMCP(MCP_Geometric):
+    """
+    MCP_Geometric which stops the cost propagation as soon as the accumulated cost exceeds max_cost.
+    """
+
+    def __init__(self, costs, max_cost):
+        super().__init__(costs)
+        self.max_cost = max_cost
+
+    def goal_reached(self, index, cumcost):
+        # Cells are settled in order of accumulated cost, so all remaining cells exceed max_cost as well
+        return 2 if cumcost > self.max_cost else 0
+
+
+def tracebacks(mcp, ends):
+    """
+    Traces the least-cost paths to all (row, col) end cells. Returns a boolean array telling which ends were reached,
+    and the path number (position of the end), row and column of all path cells, ordered by path and from source to end.
+    """
+    found = np.zeros(len(ends), dtype=bool)
+    paths_cells = []
+    for i, end in enumerate(ends):
+        try:
+            paths_cells.append(np.asarray(mcp.traceback(end), dtype=np.int64).reshape(-1, 2))
+            found[i] = True
+        except ValueError:
+            pass
+
+    cells = np.concatenate(paths_cells + [np.empty((0, 2), dtype=np.int64)])
+    path_numbers = np.repeat(np.flatnonzero(found), [len(path_cells) for path_cells in paths_cells])
+    return found, path_numbers, cells[:, 0], cells[:, 1]
+
+
+def read_cost_array(in_cost, low_memory=False, window=None):
+    """
+    Reads the first band of the cost raster, or a window of it, with NoData cells set to infinite.
+    With low_memory=True, the band is converted block by block to a float32 cache file next to the GeoTIFF
+    ('<cost raster>.float32.npy') and memory-mapped instead of being read into memory. The cache file is reused as long
+    as it is newer than the GeoTIFF. This does not bound the memory use of the cost propagation, as MCP_Geometric
+    copies the costs to float64 and allocates its accumulated cost and traceback arrays for the whole array (or window).
+    """
+    if not low_memory:
+        cost_array = in_cost.read(1, masked=True, window=window)
+        # Set NoData cells to infinite
+        cost_array[np.ma.getmask(cost_array)] = np.inf
+        return cost_array
+
+    cache_path = f"{in_cost.name}.float32.npy"
+    if not (os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(in_cost.name)
+            and np.load(cache_path, mmap_mode='r').shape == in_cost.shape):
+        logger.info(f"Writing cost raster cache '{cache_path}'...")
+        # Write to a temporary file first, so that an interrupted run does not leave an incomplete cache behind
+        temp_path = f"{cache_path}.tmp"
+        cache = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=in_cost.shape)
+        for _, block_window in in_cost.block_windows(1):
+            block = in_cost.read(1, masked=True, window=block_window, out_dtype=np.float32)
+            cache[block_window.toslices()] = np.ma.filled(block, np.inf)
+        cache.flush()
+        del cache
+        os.replace(temp_path, cache_path)
+
+    cost_array = np.load(cache_path, mmap_mode='r')
+    return cost_array if window is None else cost_array[window.toslices()]
+
+
+def cost_window(in_cost, point_coords, buffer):
+    """
+    Returns the raster window around the bounding box of the given cells (row, col), extended by buffer (in CRS units)
+    and clipped to the raster extent.
+    """
+    buffer_cols = int(math.ceil(buffer / in_cost.res[0]))
+    buffer_rows = int(math.ceil(buffer / in_cost.res[1]))
+    row_start = max(int(point_coords[:, 0].min()) - buffer_rows, 0)
+    row_stop = min(int(point_coords[:, 0].max()) + buffer_rows + 1, in_cost.height)
+    col_start = max(int(point_coords[:, 1].min()) - buffer_cols, 0)
+    col_stop = min(int(point_coords[:, 1].max()) + buffer_cols + 1, in_cost.width)
+    return Window.from_slices((row_start, row_stop), (col_start, col_stop))
+
+
+def last_unchanged_year(previous_points, points, year_field, start_year, end_year):
+    """
+    Compares the thinned points of a previous run with the current ones and returns the last year up to which they are
+    identical (coordinates, years and order), i.e. up to which the least-cost paths of the previous run are still valid.
+    Returns start_year if the paths of all years have to be calculated.
+    """
+    previous_years = previous_points[year_field].to_numpy()
+    years = points[year_field].to_numpy()
+    previous_coords = shapely.get_coordinates(previous_points.geometry.values)
+    coords = shapely.get_coordinates(points.geometry.values)
+
+    last_year = start_year
+    if len(previous_years) == 0:
+        return last_year
+    for year in range(start_year + 1, min(end_year, previous_years.max()) + 1):
+        is_previous_included = previous_years <= year
+        is_included = years <= year
+        if not (np.array_equal(previous_years[is_previous_included], years[is_included])
+                and np.array_equal(previous_coords[is_previous_included], coords[is_included])):
+            break
+        last_year = year
+    return last_year
+
+
+def add_path_points(paths, point_cells, point_years, point_ids):
+    """
+    Adds the IDs of the source and destination points of the paths and the year of the source point, identified by the
+    source and destination cells of the paths (see paths()) and the cell IDs, years and IDs of the points.
+    The destination point is the first point in the destination cell from the destination year, the source point the
+    first point with the earliest year in the source cell. Points which cannot be identified are set to missing.
+    """
+    # Sort the points by cell, year and position. The first point of a cell is then the earliest one, and the first
+    # point of a cell and year can be found by a combined key.
+    point_cells = np.asarray(point_cells, dtype=np.int64)
+    point_years = np.asarray(point_years, dtype=np.int64)
+    order = np.lexsort((np.arange(len(point_cells)), point_years, point_cells))
+    sorted_cells, sorted_years = point_cells[order], point_years[order]
+    year_span = int(point_years.max() - point_years.min()) + 1 if len(point_years) else 1
+    min_year = int(point_years.min()) if len(point_years) else 0
+    sorted_keys = sorted_cells * year_span + (sorted_years - min_year)
+
+    source_cells = paths['source_cell'].to_numpy(dtype=np.int64)
+    destination_cells = paths['destination_cell'].to_numpy(dtype=np.int64)
+    destination_years = paths['destination_year'].to_numpy(dtype=np.int64)
+
+    sources = np.minimum(np.searchsorted(sorted_cells, source_cells), max(len(order) - 1, 0))
+    is_source = (len(order) > 0) & (sorted_cells[sources] == source_cells) & (sorted_years[sources] < destination_years)
+    destination_keys = destination_cells * year_span + (destination_years - min_year)
+    destinations = np.minimum(np.searchsorted(sorted_keys, destination_keys), max(len(order) - 1, 0))
+    is_destination = (len(order) > 0) & (sorted_keys[destinations] == destination_keys)
+
+    sorted_ids = np.asarray(point_ids, dtype=np.int64)[order]
+    paths['source_point_id'] = pd.arrays.IntegerArray(sorted_ids[sources], ~is_source)
+    paths['source_year'] = pd.arrays.IntegerArray(sorted_years[sources], ~is_source)
+    paths['destination_point_id'] = pd.arrays.IntegerArray(sorted_ids[destinations], ~is_destination)
+    return paths
+
+
+def spread_edges(paths):
+    """
+    Returns the spread forest of the paths as an edge list: one row per path with a known source and destination point,
+    with the point IDs and years (int64) and the accumulated cost.
+    """
+    edges = paths[['source_point_id', 'destination_point_id', 'source_year', 'destination_year', 'accumulated_cost']]
+    edges = edges.dropna(subset=['source_point_id', 'destination_point_id'])
+    return edges.astype({'source_point_id': np.int64, 'destination_point_id': np.int64, 'source_year': np.int64,
+                         'destination_year': np.int64}).reset_index(drop=True)
+
+
+def year_paths(cost_array, known_coords, new_coords, year, max_cost=None):
+    """
+    Calculates the least-cost paths of the new points (row, col) of a year to any of the known points.
+    Returns the cells of the paths (rows, cols), their consecutive path numbers, the accumulated cost of each path and
+    the number of new points without a path.
+    """
+    new_coords_n = new_coords.shape[0]
+
+    # Calculate accumulated costs to reach known points.
+    # The propagation stops once all new points are reached (find_all_ends) or max_cost is exceeded.
+    with stage('propagate', year=year):
+        mcp = MCP_Geometric(cost_array) if max_cost is None else BoundedMCP(cost_array, max_cost)
+        acc_cost_array, traceback_array = mcp.find_costs(starts=known_coords, ends=new_coords, find_all_ends=True)
+
+    # Find least-cost paths of all new points to any known point
+    with stage('traceback', year=year):
+        found, path_numbers, path_rows, path_cols = tracebacks(mcp, new_coords)
+
+    # Get the associated costs by selecting the accumulated cost values at the path ends (= new points).
+    # Points beyond the maximum accumulated cost are treated as unreachable, as are points on the cell of a
+    # known point (no line can be created from a single cell).
+    acc_costs = np.full(new_coords_n, np.inf)
+    if found.any():
+        acc_costs[found] = acc_cost_array[new_coords[found, 0], new_coords[found, 1]]
+    if max_cost is not None:
+        found &= acc_costs <= max_cost
+    found &= np.bincount(path_numbers, minlength=new_coords_n) >= 2
+    unreachable_n = new_coords_n - found.sum()
+
+    # Keep the cells of the found paths, numbered consecutively
+    is_found_cell = found[path_numbers]
+    path_rows, path_cols = path_rows[is_found_cell], path_cols[is_found_cell]
+    line_numbers = (np.cumsum(found) - 1)[path_numbers[is_found_cell]]
+    return path_rows, path_cols, line_numbers, acc_costs[found], unreachable_n
+
+
+def share_cost_array(cost_array, cache_path=None, window=None):
+    """
+    Makes the cost array available to worker processes without copying it for each of them (see attach_cost_array()).
+    A cost array memory-mapped from the cache file of read_cost_array() is referred to by the file (cache_path) and
+    window, any other array is copied once to shared memory.
+    Returns the reference for attach_cost_array() and the SharedMemory, if any, which must be unlinked after use.
+    """
+    if cache_path is not None:
+        return ('file', cache_path, window), None
+    cost_array = np.ma.getdata(cost_array)
+    shared = shared_memory.SharedMemory(create=True, size=max(cost_array.nbytes, 1))
+    np.ndarray(cost_array.shape, dtype=cost_array.dtype, buffer=shared.buf)[:] = cost_array
+    return ('shared_memory', shared.name, cost_array.shape, cost_array.dtype.str), shared
+
+
+def attach_cost_array(reference):
+    """
+    Returns the cost array shared with share_cost_array() (read-only) and the attached SharedMemory, if any, which must
+    be kept as long as the array is used.
+    """
+    if reference[0] == 'file':
+        _, cache_path, window = reference
+        cost_array = np.load(cache_path, mmap_mode='r')
+        return (cost_array if window is None else cost_array[window.toslices()]), None
+    _, name, shape, dtype = reference
+    shared = shared_memory.SharedMemory(name=name)
+    cost_array = np.ndarray(shape, dtype=dtype, buffer=shared.buf)
+    cost_array.flags.writeable = False
+    return cost_array, shared
+
+
+def parallel_year_paths(cost_array, cache_path, window, point_coords, point_years, years, max_cost, workers,
+                        is_destination=None):
+    """
+    Calculates the paths of the given years (see year_paths()) on a pool of worker processes,
+    which share the cost array (see share_cost_array()). Only the points with is_destination get paths, if given.
+    Returns the results by year.
+    """
+    if is_destination is None:
+        is_destination = np.ones(len(point_years), dtype=bool)
+    reference, shared = share_cost_array(cost_array, cache_path, window)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_paths_worker,
+                                 initargs=(reference, max_cost)) as executor:
+            futures = {year: executor.submit(_year_paths_worker, point_coords[point_years < year],
+                                             point_coords[(point_years == year) & is_destination], year)
+                       for year in years}
+            results = {}
+            for year, future in futures.items():
+                results[year], records = future.result()
+                profiler.add_records(records)
+    finally:
+        if shared is not None:
+            shared.close()
+            shared.unlink()
+    return results
+
+
+# Cost array of a worker process of the parallel mode of paths(), attached once by _init_paths_worker()
+_worker_cost = {}
+
+
+def _init_paths_worker(reference, max_cost):
+    profiler.reset()
+    _worker_cost['array'], _worker_cost['shared'] = attach_cost_array(reference)
+    _worker_cost['max_cost'] = max_cost
+
+
+def _year_paths_worker(known_coords, new_coords, year):
+    result = year_paths(_worker_cost['array'], known_coords, new_coords, year, _worker_cost['max_cost'])
+    # Pass the stages recorded in the worker process on to the main process
+    return result, profiler.take_records()
+
+
+@profiled('paths')
+def paths(out_gpkg, out_paths, in_points, in_cost, year_field, start_year, end_year, max_cost=None, low_memory=False,
+          window_buffer=None, cache=None, writer=None, workers=1, cost_array=None, destinations=None):
     """
     Creates least-cost paths that connect each observation to the nearest earlier observation based on the least cost.
+    With max_cost, the cost propagation stops at this accumulated cost. Observations which cannot be reached within it
+    are reported like unreachable observations and get no path.
+    With low_memory=True, the cost raster is memory-mapped from a float32 cache file (see read_cost_array()). Only
+    window_buffer reduces the memory use of the cost propagation.
+    With window_buffer, only the part of the cost raster around the observations, extended by this distance (in CRS
+    units), is used. Paths cannot leave this window.
+    With a PathCache, the paths of each year are taken from the cache if the cost raster, the points up to that year and
+    the settings are unchanged, and stored in it otherwise.
+    With workers > 1, the years which are not in the cache are calculated on a pool of worker processes, which share
+    the cost array. The paths are identical to those of a serial run.
+    A cost array read with read_cost_array() from the whole cost raster can be passed on (e.g. by several runs with the
+    same cost raster), instead of being read again.
+    With destinations (a boolean array over the points), only these points get paths, and the other points are only
+    sources. Years without destinations are skipped. The PathCache is not used then, as it stores the paths of all
+    points of a year.
+    Each path records the raster cell IDs (row * raster width + col) of its source and destination cell and the IDs of
+    its source and destination point ('point_id' column of the points, or their positions) and the source year.
+    If out_gpkg is None, the paths are only returned and not saved. Otherwise they are saved with the given LayerWriter,
+    if any.
     """
-    # Initialize an empty list to store features
-    features = []
-    # Read the first band of the cost raster
-    cost_array = in_cost.read(1, masked=True)
-    # Identify NoData cells
-    nodata_mask = np.ma.getmask(cost_array)
-    # Set NoData cells to infinite
-    cost_array[nodata_mask] = np.inf
+    # Initialize empty lists to store the path attributes and geometries of each year
+    destination_years = []
+    accumulated_costs = []
+    source_cells = []
+    destination_cells = []
+    geometries = []
+
+    # Raster cells (row, col) and years of all points, looked up once. thin() already stores the cells.
+    if 'raster_row' in in_points.columns and 'raster_col' in in_points.columns:
+        point_coords = in_points[['raster_row', 'raster_col']].to_numpy(dtype=np.int64)
+    else:
+        point_coords = np.column_stack(rio.transform.rowcol(
+            in_cost.transform, in_points.geometry.x.to_numpy(), in_points.geometry.y.to_numpy())).astype(np.int64)
+    point_years = in_points[year_field].to_numpy()
+    point_cells = point_coords[:, 0] * in_cost.width + point_coords[:, 1]
+    point_ids = in_points['point_id'].to_numpy() if 'point_id' in in_points.columns else np.arange(len(in_points))
+    if destinations is None:
+        is_destination = np.ones(len(point_years), dtype=bool)
+    else:
+        is_destination = np.asarray(destinations, dtype=bool)
+        cache = None
+
+    # Read the first band of the cost raster, optionally restricted to a window around the points.
+    # The point cells and path coordinates then refer to the window.
+    transform = in_cost.transform
+    window = None
+    row_offset, col_offset = 0, 0
+    if window_buffer is not None and len(point_coords):
+        window = cost_window(in_cost, point_coords, window_buffer)
+        point_coords = point_coords - np.array([window.row_off, window.col_off])
+        transform = in_cost.window_transform(window)
+        row_offset, col_offset = window.row_off, window.col_off
+        logger.info(f"Using a cost raster window of {window.height} x {window.width} cells "
+                    f"around the observations.")
+    # The cost array and least-cost engine are only set up once a year is not found in the cache
+    given_cost_array, cost_array = cost_array, None
+
+    def load_cost_array():
+        with stage('read_cost'):
+            if given_cost_array is None:
+                return read_cost_array(in_cost, low_memory, window)
+            return given_cost_array if window is None else given_cost_array[window.toslices()]
+
+    # Everything the paths of a year depend on, apart from the points up to that year (see PathCache)
+    if cache is not None:
+        cache_settings = {
+            'cost_raster': file_hash(in_cost.name),
+            'window': None if window is None else [window.row_off, window.col_off, window.height, window.width],
+            'max_cost': max_cost
+        }
+
+    def year_cache_key(year):
+        is_included = point_years <= year
+        return cache.key(dict(cache_settings, year=year), point_coords[is_included],
+                         point_years[is_included].astype(np.int64))
+
+    # In parallel mode, the years which are not in the cache are calculated up front on a pool of worker processes
+    parallel_results = {}
+    if workers > 1:
+        parallel_years = [year for year in range(start_year + 1, end_year + 1)
+                          if (cache is None or not cache.contains(year_cache_key(year)))
+                          and (destinations is None or (is_destination & (point_years == year)).any())]
+        if parallel_years:
+            logger.info(f"Calculating least-cost paths for {len(parallel_years)} years on {workers} worker "
+                        f"processes...")
+            shared_cost_array = load_cost_array()
+            parallel_results = parallel_year_paths(
+                shared_cost_array, f"{in_cost.name}.float32.npy" if low_memory else None, window, point_coords,
+                point_years, parallel_years, max_cost, workers, is_destination)
+            del shared_cost_array
 
     # Iterate through the specified range of years.
     # start_year + 1 because no paths can be created in the first year.
     # end_year + 1 because range end is not included in range.
     for year in range(start_year + 1, end_year + 1):
-        print(f"[{dt.now().strftime('%H:%M:%S')}] Calculating least-cost paths for year {year}...")
+        is_new = (point_years == year) & is_destination
+        if destinations is not None and not is_new.any():
+            continue
+        logger.info(f"Calculating least-cost paths for year {year}...")
 
         # Select known points from previous years
-        known_points = in_points[in_points[year_field] < year]['geometry']
-        known_coords = np.array(
-            [(rio.transform.rowcol(in_cost.transform, known_point.x, known_point.y)) for known_point in known_points])
+        known_coords = point_coords[point_years < year]
 
         # Select new points from current year
-        new_points = in_points[in_points[year_field] == year]['geometry']
-        new_coords = np.array(
-            [(rio.transform.rowcol(in_cost.transform, new_point.x, new_point.y)) for new_point in new_points])
-        new_coords_n = new_coords.shape[0]
+        new_coords = point_coords[is_new]
 
-        # Calculate accumulated costs to reach known points
-        mcp = MCP_Geometric(cost_array)
-        acc_cost_array, traceback_array = mcp.find_costs(starts=known_coords, ends=new_coords, find_all_ends=True)
+        cached = None
+        if cache is not None:
+            cache_key = year_cache_key(year)
+            cached = cache.get(cache_key)
+
+        if cached is not None:
+            path_rows, path_cols = cached['path_rows'], cached['path_cols']
+            line_numbers, line_costs = cached['line_numbers'], cached['line_costs']
+            unreachable_n = int(cached['unreachable_n'])
+            logger.info(f"Least-cost paths for year {year} taken from the cache.")
+        elif year in parallel_results:
+            path_rows, path_cols, line_numbers, line_costs, unreachable_n = parallel_results.pop(year)
+        else:
+            if cost_array is None:
+                cost_array = load_cost_array()
+            path_rows, path_cols, line_numbers, line_costs, unreachable_n = year_paths(
+                cost_array, known_coords, new_coords, year, max_cost)
+
+        if cached is None and cache is not None:
+            cache.put(cache_key, path_rows=path_rows, path_cols=path_cols, line_numbers=line_numbers,
+                      line_costs=line_costs, unreachable_n=unreachable_n)
+
+        for _ in range(unreachable_n):
+            logger.info("No path found for a point.")
+
+        # Create path geometries from the cell centre coordinates of all paths at once
+        with stage('geometry', year=year):
+            path_xs, path_ys = rio.transform.xy(transform, path_rows, path_cols)
+            line_geometries = shapely.linestrings(np.asarray(path_xs), np.asarray(path_ys), indices=line_numbers)
+            geometries.append(shapely.multilinestrings(line_geometries, indices=np.arange(len(line_geometries))))
+        destination_years.append(np.full(len(line_geometries), year))
+        accumulated_costs.append(line_costs)
+
+        # Record the cell IDs (row * raster width + col) of the first (source) and last (destination) cell of each path
+        line_first_cells = np.searchsorted(line_numbers, np.arange(len(line_geometries)))
+        line_last_cells = np.searchsorted(line_numbers, np.arange(len(line_geometries)), side='right') - 1
+        cell_ids = (path_rows.astype(np.int64) + row_offset) * in_cost.width + path_cols + col_offset
+        source_cells.append(cell_ids[line_first_cells])
+        destination_cells.append(cell_ids[line_last_cells])
+
+    # Create a GeoDataFrame from the path attributes and geometries and set CRS
+    result_gdf = gpd.GeoDataFrame({
+        'destination_year': np.concatenate(destination_years + [np.empty(0, dtype=np.int64)]),
+        'accumulated_cost': np.concatenate(accumulated_costs + [np.empty(0)]),
+        'source_cell': np.concatenate(source_cells + [np.empty(0, dtype=np.int64)]),
+        'destination_cell': np.concatenate(destination_cells + [np.empty(0, dtype=np.int64)])
+    }, geometry=np.concatenate(geometries + [np.empty(0, dtype=object)]), crs=in_cost.crs)
+    add_path_points(result_gdf, point_cells, point_years, point_ids)
 
-        # Find least-cost path for each new point
-        for i in range(new_coords_n):
-            try:
-                # Find least-cost path to any known point
-                path = mcp.traceback(new_coords[i, :])
-
-                # Get the associated cost by selecting the accumulated cost value at the path end (= new point)
-                row_index, col_index = path[-1]
-                acc_cost = acc_cost_array[row_index][col_index]
-
-                # Create path geometry
-                line_strings = [LineString([in_cost.xy(coord[0], coord[1]) for coord in path])]
-                line_geometry = MultiLineString(line_strings)
-
-                # Create feature with path geometry and attributes
-                # tbd: find a way to add the year of the source point
-                feature = {
-                    'geometry': line_geometry,
-                    'properties': {
-                        'destination_year': year,
-                        'accumulated_cost': acc_cost
-                    }
-                }
-
-                # Append the feature to the features list
-                features.append(feature)
-
-            except ValueError:
-                print(f"[{dt.now().strftime('%H:%M:%S')}] INFO: No path found for a point.")
-    
-    # Create a GeoDataFrame from the list of features and set CRS
-    result_gdf = gpd.GeoDataFrame.from_features(features)
-    result_gdf.set_crs(in_cost.crs, inplace=True)
-    
     # Save the GeoDataFrame to a GeoPackage
-    result_gdf.to_file(out_gpkg, layer=out_paths)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Least-cost paths saved to '{out_gpkg}', layer '{out_paths}'.")
+    if out_gpkg is not None:
+        save_layer(result_gdf, out_gpkg, out_paths, f"Least-cost paths saved to '{out_gpkg}', layer '{out_paths}'.",
+                   writer)
+    peak_memory = peak_memory_mb()
+    if peak_memory is not None:
+        logger.info(f"Peak memory use so far: {peak_memory:.0f} MB.")
 
     # Return dataframe
     return result_gdf
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import os
+import zipfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path, chunk_size=2 ** 24):
+    """
+    Returns a content hash (BLAKE2b) of the file at the given path, read in chunks.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PathCache:
+    """
+    On-disk cache of the least-cost paths of single years, one .npz file per entry. Entries are identified by a key
+    derived from the cost raster, the points up to the year and the path settings (see key()). Once the total size of
+    the entries exceeds max_size_mb, the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(settings, *arrays):
+        """
+        Returns the key for the given settings (JSON-serialisable) and arrays.
+        """
+        digest = hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=20)
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(f"{array.dtype.str}{array.shape}".encode())
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def contains(self, key):
+        """
+        Returns whether there is an entry for the key.
+        """
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """
+        Returns the arrays stored under the key as a dictionary, or None if there is no (readable) entry.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        # Mark the entry as recently used
+        os.utime(path)
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Stores the arrays under the key and removes the least recently used entries if the cache is too large.
+        """
+        # Write to a temporary file first, so that an interrupted run does not leave an incomplete entry behind
+        temp_path = os.path.join(self.cache_dir, f"{key}.tmp.npz")
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size is within max_size_mb.
+        """
+        entries = [entry for entry in os.scandir(self.cache_dir)
+                   if entry.name.endswith('.npz') and not entry.name.endswith('.tmp.npz')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total_size = sum(entry.stat().st_size for entry in entries)
+        removed = 0
+        for entry in entries:
+            if total_size <= self.max_size_mb * 1024 ** 2:
+                break
+            total_size -= entry.stat().st_size
+            os.remove(entry.path)
+            removed += 1
+        if removed:
+            logger.info(f"Removed {removed} least recently used entries from path cache '{self.cache_dir}'.")
+
+    def clear(self):
+        """
+        Removes all entries (invalidates the cache).
+        """
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npz')]
+        for entry in entries:
+            os.remove(entry.path)
+        logger.info(f"Removed {len(entries)} entries from path cache '{self.cache_dir}'.")
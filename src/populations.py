@@ -1,71 +1,143 @@
-from datetime import datetime as dt
+import logging
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import MultiLineString, LineString, Point
+import shapely
+from src.layerio import read_layer, save_layer
+from src.profiling import profiled
 import math
 
+logger = logging.getLogger(__name__)
 
-def get_endpoints(geom):
+
+class DisjointSet:
+    """
+    Union-find structure over the integers 0 to n - 1, with path halving and union by size.
+    """
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        """
+        Merges the sets of i and j. Returns True if they were separate sets before.
+        """
+        if i == j:
+            return False
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return False
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        return True
+
+    def roots(self, items):
+        """
+        Returns the set representatives (roots) of the given items as an array.
+        """
+        return np.array([self.find(i) for i in items], dtype=np.int64)
+
+
+def endpoint_keys(geoms):
     """
-    Extracts the start and end point of a LineString or MultiLineString.
+    Returns integer keys for the start and end points of all LineString parts, identical coordinates getting the same
+    key, together with the position of the geometry each part belongs to.
     """
-    if isinstance(geom, LineString):
-        return [geom.coords[0], geom.coords[-1]]
-    elif isinstance(geom, MultiLineString):
-        return [line.coords[0] for line in geom.geoms] + [line.coords[-1] for line in geom.geoms]
+    parts, positions = shapely.get_parts(np.asarray(geoms), return_index=True)
+    starts = shapely.get_coordinates(shapely.get_point(parts, 0))
+    ends = shapely.get_coordinates(shapely.get_point(parts, -1))
+    coords = np.concatenate([starts, ends])
+    x_keys, _ = pd.factorize(coords[:, 0])
+    y_keys, y_uniques = pd.factorize(coords[:, 1])
+    keys, _ = pd.factorize(x_keys * len(y_uniques) + y_keys)
+    return keys[:len(parts)], keys[len(parts):], positions
+
+
+def path_cells(paths):
+    """
+    Returns the source and destination cell IDs of the paths (see leastcostpaths.paths()) as integer arrays, or None if
+    the paths do not have them (e.g. paths of earlier runs).
+    """
+    columns = ['source_cell', 'destination_cell']
+    if not set(columns).issubset(paths.columns) or paths[columns].isna().any(axis=None):
+        return None
+    return paths['source_cell'].to_numpy(dtype=np.int64), paths['destination_cell'].to_numpy(dtype=np.int64)
+
+
+class PathGroups:
+    """
+    Connectivity of paths which share start and/or end points, kept in a union-find over the endpoint keys.
+    Paths can be added incrementally, e.g. in order of accumulated cost. Paths are referred to by position.
+    The endpoint keys are taken from the source and destination cells of the paths if given (see path_cells()), and
+    from the endpoint coordinates of the geometries otherwise.
+    """
+
+    def __init__(self, geoms, cells=None):
+        if cells is None:
+            self.start_keys, self.end_keys, positions = endpoint_keys(geoms)
+        else:
+            keys, _ = pd.factorize(np.concatenate(cells))
+            self.start_keys, self.end_keys = keys[:len(geoms)], keys[len(geoms):]
+            positions = np.arange(len(geoms))
+        self.start_keys_list, self.end_keys_list = self.start_keys.tolist(), self.end_keys.tolist()
+        path_positions = np.arange(len(geoms))
+        self.part_starts = np.searchsorted(positions, path_positions, side='left')
+        self.part_ends = np.searchsorted(positions, path_positions, side='right')
+        self.groups = DisjointSet(2 * len(self.start_keys))
+
+    def add(self, paths):
+        """
+        Joins the start and end point of each line part, and the parts of each path.
+        """
+        paths = np.asarray(paths, dtype=np.int64)
+        union = self.groups.union
+        for part_start, part_end in zip(self.part_starts[paths].tolist(), self.part_ends[paths].tolist()):
+            first_start_key = self.start_keys_list[part_start]
+            for start_key, end_key in zip(self.start_keys_list[part_start:part_end],
+                                          self.end_keys_list[part_start:part_end]):
+                union(start_key, end_key)
+                union(start_key, first_start_key)
+
+    def group_ids(self, paths):
+        """
+        Returns the group IDs of the given (added) paths, numbered from 0 in the order of the first path of each group.
+        """
+        group_ids, _ = pd.factorize(self.groups.roots(self.start_keys[self.part_starts[paths]].tolist()))
+        return group_ids
 
 
 def group_paths(lines):
     """
     Assigns an ID to each group of MultiLineStrings which share start and/or end points.
+    The groups are found with a union-find over the source and destination cells, or the endpoint coordinates of paths
+    without cells (PathGroups). Group IDs are numbered from 0 in the order of the first path of each group.
     """
     # Work with dataframe copy to avoid warning from GeoPandas
     gdf = lines.copy()
 
-    # Adds start and endpoint to the dataframe
-    gdf['endpoints'] = gdf.geometry.apply(get_endpoints)
-
-    # Initialize column for storing the group ID
-    gdf['group_id'] = None
-
-    # Iteratively check each feature's connectivity and tag it with group ID
-    group_id = 0
-
-    while gdf['group_id'].isnull().any():
-        # Start with the first untagged feature
-        untagged = gdf[gdf['group_id'].isnull()]
-        first_untagged_idx = untagged.index[0]
-        current_endpoints = set(untagged.at[first_untagged_idx, 'endpoints'])
-
-        connected = {first_untagged_idx}
-        more_to_check = True
-
-        while more_to_check:
-            more_to_check = False
-            for idx, row in untagged.iterrows():
-                if idx not in connected:
-                    # Check if any endpoint matches
-                    if any(pt in current_endpoints for pt in row['endpoints']):
-                        connected.add(idx)
-                        current_endpoints.update(row['endpoints'])
-                        more_to_check = True
-
-        # Assign the group ID to all connected features
-        gdf.loc[list(connected), 'group_id'] = group_id
-        group_id += 1
-
-    # Cleanup before returning
-    gdf = gdf.drop(columns=['endpoints'])
-    gdf['group_id'] = gdf['group_id'].astype('string')   # group_id becomes dtype object somehow. Set as string (must be nullable)
+    paths = np.arange(len(gdf))
+    path_groups = PathGroups(gdf.geometry, path_cells(gdf))
+    path_groups.add(paths)
+    gdf['group_id'] = pd.Series(path_groups.group_ids(paths), index=gdf.index).astype('string')
     return gdf
 
 
-def statistics(in_gpkg, in_paths):
+@profiled('statistics')
+def statistics(in_gpkg, in_paths, paths=None):
     """
     Returns the upper outlier fence (Q3 + 1.5 x IQR) for accumulated cost as a quantile and an absolute value.
+    The paths are read from the GeoPackage unless given as a GeoDataFrame.
     """
-    gdf = gpd.read_file(in_gpkg, layer=in_paths)
+    gdf = read_layer(in_gpkg, in_paths, columns=['accumulated_cost'], read_geometry=False) if paths is None else paths
 
     # Calculate Q1 and Q3
     q1 = np.quantile(gdf['accumulated_cost'], 0.25)
@@ -84,17 +156,21 @@ def statistics(in_gpkg, in_paths):
     #acc_cost_test_steps = np.linspace(min_cost, max_cost, 1000)
     acc_cost_test_steps = np.arange(0.00, max_cost + 0.01, 0.01)
 
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Upper outlier fence (Q3 + 1.5 x IQR) for accumulated cost is {round(upper_bound,3)} (Q{round(upper_bound_quantile,3)}).")
+    logger.info(f"Upper outlier fence (Q3 + 1.5 x IQR) for accumulated cost is {round(upper_bound,3)} (Q{round(upper_bound_quantile,3)}).")
 
     return upper_bound_quantile, upper_bound, acc_cost_test_steps
 
 
-def group_paths_save(in_out_gpkg, in_paths, out_paths, threshold, threshold_is_absolute=False):
+@profiled('group_paths')
+def group_paths_save(in_out_gpkg, in_paths, out_paths, threshold, threshold_is_absolute=False, paths=None, writer=None):
     """
     Assigns paths to populations. This is done by ignoring paths with an accumulated cost higher than
     the input quantile parameter and checking the connectivity of the remaining paths.
+    The paths are read from the GeoPackage unless given as a GeoDataFrame. The grouped paths are saved with the given
+    LayerWriter, if any.
     """
-    paths = gpd.read_file(in_out_gpkg, layer=in_paths)
+    if paths is None:
+        paths = read_layer(in_out_gpkg, in_paths)
 
     if threshold_is_absolute:
         # Treat input value as absolute value
@@ -109,58 +185,147 @@ def group_paths_save(in_out_gpkg, in_paths, out_paths, threshold, threshold_is_a
         threshold_as_cost = np.quantile(paths['accumulated_cost'], threshold_as_quantile)
 
     paths_filtered = paths[paths['accumulated_cost'] < threshold_as_cost]
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Least-cost paths with accumulated cost < {round(threshold_as_cost,3)} (Q{round(threshold_as_quantile,3)}) loaded.")
+    logger.info(f"Least-cost paths with accumulated cost < {round(threshold_as_cost,3)} (Q{round(threshold_as_quantile,3)}) loaded.")
 
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Grouping least-cost paths by their connectivity...")
+    logger.info("Grouping least-cost paths by their connectivity...")
     paths_filtered_grouped = group_paths(paths_filtered)
 
     # Save the selected and tagged paths to the GeoPackage which specific to the script run
-    paths_filtered_grouped.to_file(in_out_gpkg, layer=out_paths)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Grouped least-cost paths saved to '{in_out_gpkg}', layer '{out_paths}'.")
+    save_layer(paths_filtered_grouped, in_out_gpkg, out_paths,
+               f"Grouped least-cost paths saved to '{in_out_gpkg}', layer '{out_paths}'.", writer)
 
     # Return dataframe (currently only needed for the usage in Jupyter notebook)
     return paths_filtered_grouped
 
 
-def group_points(in_points, in_paths, cell_size):
-
-    in_points['point_id'] = in_points.index
-    half_diagonal = (math.sqrt(2) * cell_size) / 2
-
-    # Extract endpoints of all paths and create a dataframe
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Assigning observations to the groups formed by least-cost paths...")
-    endpoints = []
+class PointCells:
+    """
+    Maps presence points to the path endpoints within half a cell diagonal, to assign the points to the groups of any
+    subset of the paths (see group_points()). The endpoints lie on cell centres, so only the four cell centres around
+    a point can be that close. The mapping is built once, each assignment then only needs integer array lookups.
+    Paths are referred to by position.
+    """
 
-    for index, path in in_paths.iterrows():
-        points = get_endpoints(path.geometry)
-        for point in points:
-            # Append endpoint geometry and group_id to the list
-            endpoints.append({'geometry': Point(point), 'group_id': path.group_id})
+    def __init__(self, points, paths, cell_size):
+        self.half_diagonal = (math.sqrt(2) * cell_size) / 2
+
+        # Endpoints per path: the start points of all its parts, then their end points
+        parts, part_paths = shapely.get_parts(np.asarray(paths), return_index=True)
+        coords = np.concatenate([shapely.get_coordinates(shapely.get_point(parts, 0)),
+                                 shapely.get_coordinates(shapely.get_point(parts, -1))])
+        endpoint_paths = np.concatenate([part_paths, part_paths])
+        order = np.lexsort((np.tile(np.arange(len(parts)), 2), np.repeat([0, 1], len(parts)), endpoint_paths))
+        coords, self.endpoint_paths = coords[order], endpoint_paths[order]
+        self.n_paths = len(paths)
+
+        # Endpoint locations (identical coordinates) and their cells, counted from the first location
+        x_keys, _ = pd.factorize(coords[:, 0])
+        y_keys, y_uniques = pd.factorize(coords[:, 1])
+        self.endpoint_locations, location_keys = pd.factorize(x_keys * len(y_uniques) + y_keys)
+        location_coords = np.empty((len(location_keys), 2))
+        location_coords[self.endpoint_locations] = coords
+        origin = location_coords[0] if len(location_coords) else np.zeros(2)
+        location_cells = np.rint((location_coords - origin) / cell_size).astype(np.int64)
+        location_index = pd.MultiIndex.from_arrays([location_cells[:, 0], location_cells[:, 1]])
+
+        # Candidate locations of each point: the centres of the cells below/above and left/right of the point which
+        # have an endpoint within half a cell diagonal
+        x, y = points.geometry.x.to_numpy(), points.geometry.y.to_numpy()
+        is_valid = np.isfinite(x) & np.isfinite(y)
+        point_positions = np.repeat(np.flatnonzero(is_valid), 4)
+        col = np.floor((x[is_valid] - origin[0]) / cell_size).astype(np.int64)
+        row = np.floor((y[is_valid] - origin[1]) / cell_size).astype(np.int64)
+        locations = location_index.get_indexer(pd.MultiIndex.from_arrays([
+            (col[:, np.newaxis] + [0, 0, 1, 1]).ravel(), (row[:, np.newaxis] + [0, 1, 0, 1]).ravel()]))
+        is_candidate = locations >= 0
+        point_positions, locations = point_positions[is_candidate], locations[is_candidate]
+        dx = x[point_positions] - location_coords[locations, 0]
+        dy = y[point_positions] - location_coords[locations, 1]
+        distances = np.sqrt(dx * dx + dy * dy)
+        is_candidate = distances <= self.half_diagonal
+        self.candidate_points = point_positions[is_candidate]
+        self.candidate_locations = locations[is_candidate]
+        self.candidate_distances = distances[is_candidate]
+        self.n_points = len(x)
+        self.n_locations = len(location_keys)
+
+    def assign(self, paths):
+        """
+        Returns, for each point, the index (into paths) of the path with the nearest endpoint, or -1 if no endpoint is
+        within half a cell diagonal, and the distance to that endpoint. Of several endpoints at the same distance, the
+        first one wins (in path order).
+        """
+        paths = np.asarray(paths, dtype=np.int64)
+        path_indices = np.full(self.n_paths, -1)
+        path_indices[paths] = np.arange(len(paths))
+        endpoint_indices = path_indices[self.endpoint_paths]
+
+        # First endpoint of the given paths at each location
+        included = np.flatnonzero(endpoint_indices >= 0)
+        first_endpoints = np.full(self.n_locations, -1)
+        locations, first = np.unique(self.endpoint_locations[included], return_index=True)
+        first_endpoints[locations] = included[first]
+
+        # Nearest candidate location of each point with an endpoint of the given paths, on equal distance the one with
+        # the first endpoint
+        candidate_endpoints = first_endpoints[self.candidate_locations]
+        is_included = candidate_endpoints >= 0
+        candidate_points = self.candidate_points[is_included]
+        candidate_distances = self.candidate_distances[is_included]
+        candidate_endpoints = candidate_endpoints[is_included]
+        order = np.lexsort((candidate_endpoints, candidate_distances, candidate_points))
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = candidate_points[order][1:] != candidate_points[order][:-1]
+        nearest = order[is_first]
+
+        point_paths = np.full(self.n_points, -1)
+        point_paths[candidate_points[nearest]] = endpoint_indices[candidate_endpoints[nearest]]
+        point_distances = np.full(self.n_points, np.nan)
+        point_distances[candidate_points[nearest]] = candidate_distances[nearest]
+        return point_paths, point_distances
+
+    def group_points(self, points, paths, group_ids):
+        """
+        Returns a copy of the points (the ones the mapping was built for) with the group ID of the given paths
+        (positions) with the nearest endpoint and the distance to it (see assign()).
+        """
+        logger.info("Assigning observations to the groups formed by least-cost paths...")
+        point_paths, point_distances = self.assign(paths)
+        # Index -1 (no path) selects the appended missing value
+        group_ids = np.append(np.asarray(group_ids, dtype=object), pd.NA)
+        out_points = points.copy()
+        out_points['group_id'] = pd.array(group_ids[point_paths], dtype='string')
+        out_points['dist'] = point_distances
+        return out_points
 
-    gdf_endpoints = gpd.GeoDataFrame(endpoints, crs=in_paths.crs)
-    gdf_endpoints['group_id'] = gdf_endpoints['group_id'].astype('string')  # group_id becomes dtype object somehow. Set as string (must be nullable)
 
-    # Spatial join: assigns each point the group_id of the nearest endpoint
-    out_points = gpd.sjoin_nearest(in_points, gdf_endpoints[['geometry', 'group_id']], how='left', max_distance=half_diagonal, distance_col='dist')
-    # Drop duplicated points (duplication occurs when more than one path has an endpoint in the same cell)
-    out_points.drop_duplicates(subset=['point_id'], keep='first', inplace=True)
-    out_points.drop(columns=['index_right', 'point_id'], inplace=True)
-    return out_points
+def group_points(in_points, in_paths, cell_size):
+    """
+    Assigns each point the group ID of the path with the nearest endpoint within half a cell diagonal. If several paths
+    have an endpoint in the same cell, the first path wins.
+    """
+    point_cells = PointCells(in_points, in_paths.geometry, cell_size)
+    return point_cells.group_points(in_points, np.arange(len(in_paths)), in_paths['group_id'])
 
 
-def group_points_save(in_out_gpkg, in_points, in_paths, out_points, cell_size):
+@profiled('group_points')
+def group_points_save(in_out_gpkg, in_points, in_paths, out_points, cell_size, points=None, paths=None, writer=None):
     """
-    Assigns presence points to populations using a spatial join (nearest).
+    Assigns presence points to populations: each point gets the group of the path with the nearest endpoint within half
+    a cell diagonal, which is looked up through the mapping of points to endpoint cells (see PointCells).
     Coordinate matching is not possible here because the path endpoints are centered on cost surface cells.
+    The points and paths are read from the GeoPackage unless given as GeoDataFrames. The grouped points are saved with
+    the given LayerWriter, if any.
     """
-    gdf_points = gpd.read_file(in_out_gpkg, layer=in_points)
-    gdf_paths = gpd.read_file(in_out_gpkg, layer=in_paths)
+    # Work with a copy of given points, as group_points() adds a column
+    gdf_points = read_layer(in_out_gpkg, in_points) if points is None else points.copy()
+    gdf_paths = read_layer(in_out_gpkg, in_paths) if paths is None else paths
 
     gdf_points = group_points(gdf_points, gdf_paths, cell_size)
 
     # Save the selected and tagged paths to the GeoPackage which is specific to the script run
-    gdf_points.to_file(in_out_gpkg, layer=out_points)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Grouped observations saved to '{in_out_gpkg}', layer '{out_points}'.")
+    save_layer(gdf_points, in_out_gpkg, out_points,
+               f"Grouped observations saved to '{in_out_gpkg}', layer '{out_points}'.", writer)
 
     # Return dataframe (needed for sensitivity test and Jupyter notebook)
     return gdf_points
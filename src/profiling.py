@@ -0,0 +1,216 @@
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(level='INFO'):
+    """
+    Sets up the log messages of the run in the format '[HH:MM:SS] message' on stdout. Use level 'WARNING' to only see
+    warnings and errors in batch runs, or 'DEBUG' to additionally see the start of each stage.
+    """
+    logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%H:%M:%S', level=level, stream=sys.stdout,
+                        force=True)
+
+
+# Peak RSS of the process before the last reset of VmHWM, and the peaks of the open stages (see Profiler.stage())
+_memory_lock = threading.Lock()
+_process_peak_mb = 0.0
+_open_stage_peaks = {}
+
+
+def _read_hwm_mb():
+    """
+    Returns the peak resident set size (RSS) since the last reset (VmHWM) in MB on Linux, or None if not available.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_hwm():
+    """
+    Resets VmHWM to the current RSS on Linux. Returns False if this is not possible.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _track_stage_memory(key, start):
+    """
+    Adds the peak RSS since the last reset to the peaks of all open stages and resets it. Then registers the stage with
+    the given key (start=True), or removes it and returns its peak in MB. Returns None if VmHWM cannot be reset.
+    """
+    global _process_peak_mb
+    with _memory_lock:
+        peak = _read_hwm_mb()
+        if peak is None or not _reset_hwm():
+            return None
+        _process_peak_mb = max(_process_peak_mb, peak)
+        for open_key, open_peak in _open_stage_peaks.items():
+            _open_stage_peaks[open_key] = max(open_peak, peak)
+        if start:
+            _open_stage_peaks[key] = 0.0
+            return None
+        return _open_stage_peaks.pop(key, None)
+
+
+def peak_memory_mb():
+    """
+    Returns the peak resident set size (RSS) of the current process since its start in MB, or None if it cannot be
+    determined. Uses the resource module on Linux/macOS and psutil (if installed) on Windows.
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux. On Linux, it only covers the time since the last
+    # reset of VmHWM by the profiler.
+    peak = peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    return max(peak, _process_peak_mb)
+
+
+class Profiler:
+    """
+    Records the wall time, CPU time (of the whole process) and peak memory of pipeline stages. Stages can be nested and
+    are named by their path, e.g. 'paths/propagate'. Additional fields, like the year, are recorded with the stage. One
+    stage can be run under cProfile (see enable_cprofile()).
+    peak_memory_mb is the peak RSS of the process while the stage ran, including other threads. It is measured by
+    resetting VmHWM at the start and end of each stage and is only available on Linux (None otherwise).
+    process_peak_memory_mb is the peak RSS of the process from its start to the end of the stage (see peak_memory_mb()).
+    """
+
+    def __init__(self):
+        self.records = []
+        self.start_time = time.perf_counter()
+        self.cprofile_stage = None
+        self.cprofile = None
+        self._local = threading.local()
+
+    def enable_cprofile(self, stage_name):
+        """
+        Runs all calls of the stage with the given name (path) under cProfile. Save the statistics with
+        write_cprofile().
+        """
+        self.cprofile_stage = stage_name
+        self.cprofile = cProfile.Profile()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(name)
+        path = '/'.join(stack)
+        logger.debug(f"Stage '{path}' started (process {os.getpid()}).")
+        profile = self.cprofile if path == self.cprofile_stage else None
+        memory_key = object()
+        _track_stage_memory(memory_key, start=True)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            stack.pop()
+            stage_peak_memory = _track_stage_memory(memory_key, start=False)
+            self.records.append({
+                'stage': path,
+                **fields,
+                'start_s': wall_start - self.start_time,
+                'wall_s': time.perf_counter() - wall_start,
+                'cpu_s': time.process_time() - cpu_start,
+                'peak_memory_mb': stage_peak_memory,
+                'process_peak_memory_mb': peak_memory_mb()
+            })
+
+    def reset(self):
+        """
+        Removes the records and the current stages, e.g. those inherited by a forked worker process.
+        """
+        self.records = []
+        self._local = threading.local()
+        with _memory_lock:
+            _open_stage_peaks.clear()
+
+    def take_records(self):
+        """
+        Returns the records and removes them from the profiler (used to pass the records of worker processes on).
+        """
+        records, self.records = self.records, []
+        return records
+
+    def add_records(self, records):
+        """
+        Adds records of another process (see take_records()), as stages nested in the current stage.
+        """
+        stack = getattr(self._local, 'stack', None) or []
+        for record in records:
+            self.records.append(dict(record, stage='/'.join(stack + [record['stage']])))
+
+    def write(self, out_path):
+        """
+        Writes the records to JSON if the path ends with '.json', and to CSV otherwise.
+        """
+        records = pd.DataFrame(self.records)
+        if out_path.lower().endswith('.json'):
+            records.to_json(out_path, orient='records', indent=1)
+        else:
+            records.to_csv(out_path, index=False)
+        logger.info(f"Run profile saved to '{out_path}'.")
+
+    def write_cprofile(self, out_path):
+        """
+        Saves the cProfile statistics of the stage (see enable_cprofile()) in the pstats format, e.g. for snakeviz.
+        """
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(out_path)
+            logger.info(f"cProfile statistics of stage '{self.cprofile_stage}' saved to '{out_path}'.")
+
+
+# Profiler of the process, used by all modules
+profiler = Profiler()
+
+
+def stage(name, **fields):
+    """
+    Records a stage with the profiler of the process: 'with stage("name", year=year): ...'.
+    """
+    return profiler.stage(name, **fields)
+
+
+def profiled(name):
+    """
+    Decorator which records each call of a function as a stage with the profiler of the process.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,52 +1,193 @@
-from datetime import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+import logging
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-from src.populations import group_paths, group_points
+from src.populations import PathGroups, PointCells, path_cells
 from src.expansionrate import expansion_rate
+from src.layerio import read_layer, write_table
+from src.profiling import profiler, profiled, stage
 
+logger = logging.getLogger(__name__)
 
-def sensitivity_analysis(in_gpkg, in_points, in_paths, out_csv_outlier_test, cell_size, year_field, location_field, acc_cost_test_steps, acc_cost_steps_are_absolute, robust_test_steps):
+
+# Points and paths of a worker process, loaded once by _init_worker()
+_worker_data = {}
+
+
+def _init_worker(in_gpkg, in_points, in_paths, year_field, location_field):
+    profiler.reset()
+    _worker_data['points'] = read_layer(in_gpkg, in_points, columns=[year_field, location_field])
+    _worker_data['paths'] = read_layer(in_gpkg, in_paths, columns=['accumulated_cost', 'source_cell', 'destination_cell'])
+
+
+def _rates_by_path_count_worker(args):
+    order, path_counts, cell_size, year_field, location_field = args
+    exp_rates_by_count = rates_by_path_count(_worker_data['points'], _worker_data['paths'], order, path_counts,
+                                             cell_size, year_field, location_field)
+    # Pass the stages recorded in the worker process on to the main process
+    return exp_rates_by_count, profiler.take_records()
+
+
+def rates_by_path_count(gdf_points, gdf_paths, order, path_counts, cell_size, year_field, location_field):
     """
-    Runs a sensitivity analysis over a range of thresholds (quantiles) to determine the impact on the number of resulting populations.
+    Calculates the expansion rates of the populations formed by the first n paths in the given order (ascending
+    accumulated cost), for each n in path_counts (ascending). Paths are added to a union-find incrementally and the
+    points are assigned to the groups with a mapping to the path endpoints built once (PointCells).
+    Returns a dictionary of expansion rate dataframes by path count.
     """
-    gdf_points = gpd.read_file(in_gpkg, layer=in_points)
-    gdf_paths = gpd.read_file(in_gpkg, layer=in_paths)
+    path_groups = PathGroups(gdf_paths.geometry, path_cells(gdf_paths))
+    point_cells = PointCells(gdf_points, gdf_paths.geometry, cell_size)
+    exp_rates_by_count = {}
+    added = 0
+
+    for path_count in path_counts:
+        with stage('step', path_count=int(path_count)):
+            path_groups.add(order[added:path_count])
+            added = path_count
+
+            # Group paths and assign population IDs based on connectivity (like group_paths(), in original path order)
+            included = np.sort(order[:path_count])
+            group_ids = pd.Series(path_groups.group_ids(included)).astype('string')
+
+            # Group points and assign population IDs based on nearness to grouped paths (like group_points())
+            grouped_points = point_cells.group_points(gdf_points, included, group_ids)
+
+            # Calculate expansion rates and stats for populations
+            _, exp_rates_by_count[path_count] = expansion_rate(grouped_points, year_field, location_field)
+
+    return exp_rates_by_count
+
 
+def step_thresholds(costs, acc_cost_test_steps, acc_cost_steps_are_absolute):
+    """
+    Returns the accumulated cost thresholds of the test steps: the steps themselves if they are absolute, and the
+    quantiles of the path costs otherwise.
+    """
     if acc_cost_steps_are_absolute:
-        print(f"[{dt.now().strftime('%H:%M:%S')}] Testing accumulated cost thresholds (absolute) from {round(acc_cost_test_steps[0],3)} to {round(acc_cost_test_steps[-1],3)} and robust population definitions from {robust_test_steps[0]} to {robust_test_steps[-1]} median observations per year...")
+        return np.asarray(acc_cost_test_steps, dtype=np.float64)
+    return np.quantile(costs, acc_cost_test_steps)
+
+
+def change_point_intervals(costs, thresholds=None):
+    """
+    Returns the intervals of thresholds (threshold_from, exclusive, to threshold_to, inclusive) in which the same paths
+    have an accumulated cost below the threshold, with the number of these paths (path_count). The populations can only
+    change at the distinct accumulated costs of the paths, which bound the intervals. With thresholds given, only the
+    intervals which contain any of them are returned.
+    """
+    sorted_costs = np.sort(costs)
+    distinct_costs = np.unique(sorted_costs)
+    intervals = pd.DataFrame({
+        'threshold_from': np.insert(distinct_costs, 0, -np.inf),
+        'threshold_to': np.append(distinct_costs, np.inf),
+        'path_count': np.append(np.searchsorted(sorted_costs, distinct_costs, side='left'), len(costs))
+    })
+    if thresholds is not None:
+        intervals = intervals.iloc[np.unique(np.searchsorted(intervals['threshold_to'].to_numpy(), thresholds,
+                                                             side='left'))].reset_index(drop=True)
+    return intervals
+
+
+def expand_sensitivity_intervals(intervals, costs, acc_cost_test_steps, acc_cost_steps_are_absolute):
+    """
+    Expands the interval table of sensitivity_analysis() with change_points=True to one row per test step and robust
+    population definition, like the table of sensitivity_analysis() with change_points=False. The costs are the
+    accumulated costs of the paths (needed for quantile steps). Raises a ValueError if a step is in none of the
+    intervals, i.e. the interval table was calculated for other steps.
+    """
+    thresholds = step_thresholds(costs, acc_cost_test_steps, acc_cost_steps_are_absolute)
+    # The intervals are identified by their path count, which does not depend on the precision of saved thresholds
+    step_path_counts = np.searchsorted(np.sort(costs), thresholds, side='left')
+    interval_path_counts = intervals['path_count'].to_numpy()
+    starts = np.flatnonzero(np.concatenate([[True], interval_path_counts[1:] != interval_path_counts[:-1]]))
+    robust_count = len(intervals.index) // len(starts)
+
+    positions = np.minimum(np.searchsorted(interval_path_counts[starts], step_path_counts), len(starts) - 1)
+    first_rows = starts[positions]
+    is_covered = interval_path_counts[first_rows] == step_path_counts
+    if not is_covered.all():
+        raise ValueError(f"{(~is_covered).sum()} test steps are not in the intervals of the sensitivity test.")
+
+    rows = (first_rows[:, np.newaxis] + np.arange(robust_count)).ravel()
+    results = intervals.iloc[rows].drop(columns='quantile', errors='ignore').reset_index(drop=True)
+    if acc_cost_steps_are_absolute:
+        # Share of paths below the threshold
+        quantiles = results['path_count'].to_numpy() / len(costs)
     else:
-        print(f"[{dt.now().strftime('%H:%M:%S')}] Testing accumulated cost thresholds (quantiles) from Q{round(acc_cost_test_steps[0],3)} to Q{round(acc_cost_test_steps[-1],3)} and robust population definitions from {robust_test_steps[0]} to {robust_test_steps[-1]} median observations per year...")
+        quantiles = np.repeat(np.asarray(acc_cost_test_steps, dtype=np.float64), robust_count)
+    results.insert(0, 'quantile', quantiles)
+    results.insert(1, 'threshold', np.repeat(thresholds, robust_count))
+    return results.drop(columns=['threshold_from', 'threshold_to', 'path_count'])
 
-    results = []
 
-    for step in acc_cost_test_steps:
-        # Copy the GeoDataFrame to avoid modifying the original
-        gdf_points_copy = gdf_points.copy()
-        gdf_paths_copy = gdf_paths.copy()
-
-        # Calculate threshold to filter paths
-        if acc_cost_steps_are_absolute:
-            # Treat input value as an absolute value
-            threshold = step
-            # Calculate what quantile this represents (percentage of values below the threshold)
-            values_below_threshold = pd.Series(gdf_paths_copy['accumulated_cost'] < threshold).sum()
-            total_values = len(gdf_paths_copy)
-            quantile = values_below_threshold / total_values
-        else:
-            # Treat input value as a quantile
-            quantile = step
-            threshold = np.quantile(gdf_paths_copy['accumulated_cost'], quantile)
+@profiled('sensitivity_analysis')
+def sensitivity_analysis(in_gpkg, in_points, in_paths, out_csv_outlier_test, cell_size, year_field, location_field, acc_cost_test_steps, acc_cost_steps_are_absolute, robust_test_steps, workers=1, points=None, paths=None, change_points=False):
+    """
+    Runs a sensitivity analysis over a range of thresholds (quantiles) to determine the impact on the number of resulting populations.
+    The populations are only calculated once per interval of thresholds in which they are the same (see
+    change_point_intervals()). With change_points=True, one row per interval and robust population definition is saved
+    (threshold_from, threshold_to, path_count, quantile and the results) instead of one row per test step, see
+    expand_sensitivity_intervals(). Then acc_cost_test_steps can be None to test all intervals.
+    With workers > 1, the thresholds are distributed to a pool of worker processes, which read the layers themselves.
+    Otherwise, the points and paths are read from the GeoPackage unless given as GeoDataFrames.
+    """
+    if acc_cost_test_steps is None and not change_points:
+        raise ValueError("Test steps are required unless the sensitivity test runs with change_points=True.")
 
-        # Apply quantile threshold to filter paths
-        gdf_paths_copy = gdf_paths_copy[gdf_paths_copy['accumulated_cost'] < threshold]
+    # Only the columns needed for grouping and expansion rates are read
+    if points is None:
+        points = read_layer(in_gpkg, in_points, columns=[year_field, location_field])
+    if paths is None:
+        paths = read_layer(in_gpkg, in_paths, columns=['accumulated_cost', 'source_cell', 'destination_cell'])
+    gdf_points, gdf_paths = points, paths
 
-        if len(gdf_paths_copy) == 0:
+    if acc_cost_test_steps is None:
+        logger.info(f"Testing all accumulated cost thresholds at which the populations change and robust population definitions from {robust_test_steps[0]} to {robust_test_steps[-1]} median observations per year...")
+    elif acc_cost_steps_are_absolute:
+        logger.info(f"Testing accumulated cost thresholds (absolute) from {round(acc_cost_test_steps[0],3)} to {round(acc_cost_test_steps[-1],3)} and robust population definitions from {robust_test_steps[0]} to {robust_test_steps[-1]} median observations per year...")
+    else:
+        logger.info(f"Testing accumulated cost thresholds (quantiles) from Q{round(acc_cost_test_steps[0],3)} to Q{round(acc_cost_test_steps[-1],3)} and robust population definitions from {robust_test_steps[0]} to {robust_test_steps[-1]} median observations per year...")
+
+    # Thresholds of all steps, and the intervals of thresholds in which the populations are the same
+    costs = gdf_paths['accumulated_cost'].to_numpy()
+    if acc_cost_test_steps is None:
+        intervals = change_point_intervals(costs)
+    else:
+        intervals = change_point_intervals(costs, step_thresholds(costs, acc_cost_test_steps,
+                                                                  acc_cost_steps_are_absolute))
+
+    # Raising the threshold only ever adds paths, so each interval is defined by the number of paths below its
+    # thresholds. Populations and expansion rates are only calculated once for each interval.
+    order = np.argsort(costs, kind='stable')
+    path_counts = intervals['path_count'].to_numpy()
+    distinct_path_counts = path_counts[path_counts > 0]
+
+    if workers > 1:
+        # Split the path counts into contiguous chunks, several per worker to balance the load.
+        # Each worker process loads the points and paths once.
+        chunks = [chunk for chunk in np.array_split(distinct_path_counts, workers * 4) if len(chunk)]
+        logger.info(f"Distributing {len(distinct_path_counts)} distinct thresholds to {workers} worker processes...")
+        exp_rates_by_count = {}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(in_gpkg, in_points, in_paths, year_field, location_field)) as executor:
+            for chunk_results, chunk_records in executor.map(_rates_by_path_count_worker, [
+                    (order, chunk, cell_size, year_field, location_field) for chunk in chunks]):
+                exp_rates_by_count.update(chunk_results)
+                profiler.add_records(chunk_records)
+    else:
+        exp_rates_by_count = rates_by_path_count(gdf_points, gdf_paths, order, distinct_path_counts, cell_size,
+                                                 year_field, location_field)
+
+    results = []
+
+    for threshold_from, threshold_to, path_count in intervals.itertuples(index=False):
+        interval = {'threshold_from': threshold_from, 'threshold_to': threshold_to, 'path_count': path_count}
+
+        if path_count == 0:
             # No paths meets threshold criterion, set default values
             for robust_step in robust_test_steps:
                 results.append({
-                    'quantile': quantile,
-                    'threshold': threshold,
+                    **interval,
                     'definition_robust': robust_step,
                     'num_groups': 0,
                     'num_groups_robust': 0,
@@ -55,14 +196,7 @@ def sensitivity_analysis(in_gpkg, in_points, in_paths, out_csv_outlier_test, cel
                     'avg_rate': float('nan')
                 })
         else:
-            # Group paths and assign population IDs based on connectivity
-            grouped_paths = group_paths(gdf_paths_copy)
-
-            # Group points and assign population IDs based on nearness to grouped paths
-            grouped_points = group_points(gdf_points_copy, grouped_paths, cell_size)
-
-            # Calculate expansion rates and stats for populations
-            _, exp_rates = expansion_rate(grouped_points, year_field, location_field)
+            exp_rates = exp_rates_by_count[path_count]
 
             # Count populations overall and for robust populations
             num_groups = exp_rates['group_id'].nunique()
@@ -78,8 +212,7 @@ def sensitivity_analysis(in_gpkg, in_points, in_paths, out_csv_outlier_test, cel
                 avg_rate = robust_populations['expansion_rate'].mean()
 
                 # Record the results
-                results.append({'quantile': quantile,
-                                'threshold': threshold,
+                results.append({**interval,
                                 'definition_robust': robust_step,
                                 'num_groups': num_groups,
                                 'num_groups_robust': num_groups_robust,
@@ -88,5 +221,13 @@ def sensitivity_analysis(in_gpkg, in_points, in_paths, out_csv_outlier_test, cel
                                 'avg_rate': avg_rate
                                 })
 
-    pd.DataFrame(results).to_csv(out_csv_outlier_test, index=False)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Test results saved to '{out_csv_outlier_test}'.")
+    results = pd.DataFrame(results)
+    if change_points:
+        # Share of paths below the thresholds of each interval
+        results.insert(3, 'quantile', results['path_count'] / len(costs))
+        write_table(results, out_csv_outlier_test)
+        logger.info(f"Test results of {len(intervals.index)} threshold intervals saved to '{out_csv_outlier_test}'.")
+    else:
+        write_table(expand_sensitivity_intervals(results, costs, acc_cost_test_steps, acc_cost_steps_are_absolute),
+                    out_csv_outlier_test)
+        logger.info(f"Test results saved to '{out_csv_outlier_test}'.")
@@ -1,19 +1,142 @@
-from datetime import datetime as dt
 import geopandas as gpd
+import logging
 import numpy as np
-from shapely.geometry import Polygon, box
+import pandas as pd
+import pyogrio
+import rasterio as rio
+import shapely
+from rasterio.warp import transform_bounds
+from shapely.geometry import box
+from src.layerio import save_layer, use_arrow
+from src.profiling import profiled
 
+logger = logging.getLogger(__name__)
 
-def thin(in_gpkg, in_points, in_cost, out_gpkg, out_points, out_points_thinned, year_field, start_year, end_year, location_field):
+
+def fishnet_cells(x, y, x_range, y_range, cell_size):
+    """
+    Finds the fishnet cells which contain the given point coordinates. Cells span from x_range[i] to x_range[i] +
+    cell_size (and likewise for y) and are numbered i * len(y_range) + j. Points on a shared edge are contained in all
+    adjacent cells, like in a spatial join with fishnet polygons (predicate "intersects").
+    Returns the positions of the points and the ids of their cells, one entry per point and cell.
+    """
+    # Candidate columns and rows around the estimated cell, checked against the exact cell edges
+    offsets = np.array([-1, 0, 1])
+    cols = np.floor((x - x_range[0]) / cell_size).astype(np.int64)[:, np.newaxis] + offsets
+    rows = np.floor((y - y_range[0]) / cell_size).astype(np.int64)[:, np.newaxis] + offsets
+    cols_valid = (cols >= 0) & (cols < len(x_range))
+    rows_valid = (rows >= 0) & (rows < len(y_range))
+    cols, rows = np.clip(cols, 0, len(x_range) - 1), np.clip(rows, 0, len(y_range) - 1)
+    cols_valid &= (x_range[cols] <= x[:, np.newaxis]) & (x[:, np.newaxis] <= x_range[cols] + cell_size)
+    rows_valid &= (y_range[rows] <= y[:, np.newaxis]) & (y[:, np.newaxis] <= y_range[rows] + cell_size)
+
+    point_positions, col_offsets, row_offsets = np.nonzero(cols_valid[:, :, np.newaxis] & rows_valid[:, np.newaxis, :])
+    cell_ids = cols[point_positions, col_offsets] * len(y_range) + rows[point_positions, row_offsets]
+    return point_positions, cell_ids
+
+
+def earliest_per_cell(point_positions, cell_ids, years):
+    """
+    Returns the positions of the points with the minimum year in each fishnet cell (see fishnet_cells()), in the order
+    of the cells. On equal years the first point is retained.
+    """
+    order = np.lexsort((point_positions, years[point_positions], cell_ids))
+    cell_ids, point_positions = cell_ids[order], point_positions[order]
+    is_first = np.ones(len(cell_ids), dtype=bool)
+    is_first[1:] = cell_ids[1:] != cell_ids[:-1]
+    return point_positions[is_first]
+
+
+def source_bbox(source_crs, raster_crs, raster_bounds):
+    """
+    Returns the bounding box of the raster extent in the CRS of the presence data, padded by 1% on each side so that it
+    contains all points within the raster extent despite the curved edges of the transformed extent. Returns None if it
+    cannot be determined, e.g. for an extent crossing the antimeridian.
+    """
+    if source_crs is None:
+        return None
+    if rio.crs.CRS.from_user_input(source_crs) == raster_crs:
+        return tuple(raster_bounds)
+    try:
+        xmin, ymin, xmax, ymax = transform_bounds(raster_crs, source_crs, *raster_bounds, densify_pts=100)
+    except Exception:
+        return None
+    if not (np.isfinite([xmin, ymin, xmax, ymax]).all() and xmin < xmax and ymin < ymax):
+        return None
+    pad_x, pad_y = (xmax - xmin) * 0.01, (ymax - ymin) * 0.01
+    return xmin - pad_x, ymin - pad_y, xmax + pad_x, ymax + pad_y
+
+
+def read_point_batches(in_gpkg, in_points, year_field, location_field, start_year, end_year, crs_code, raster_bounds,
+                       batch_size):
+    """
+    Reads the presence points within the years and the raster extent in batches of batch_size rows, projected to the
+    cost surface CRS (crs_code). The year filter (if the year field is an integer field) and the bounding box of the
+    raster extent are applied by the reader, so that other rows are neither loaded nor projected.
+    The batches are read through Arrow if pyarrow is installed, and all at once otherwise.
+    Returns the CRS and row count of the layer and a generator of the batches.
+    """
+    info = pyogrio.read_info(in_gpkg, layer=in_points)
+    field_dtypes = dict(zip(info['fields'], info['dtypes']))
+    # Columns in the order of the layer
+    columns = [field for field in info['fields'] if field in (year_field, location_field)]
+    where = None
+    if field_dtypes.get(year_field, '').startswith('int'):
+        where = f'"{year_field}" >= {int(start_year)} AND "{year_field}" <= {int(end_year)}'
+    bbox = source_bbox(info['crs'], crs_code, raster_bounds)
+    raster_bbox = box(*raster_bounds)
+
+    def prepare(points):
+        points = points.dropna(subset=[year_field, 'geometry']).astype({year_field: 'int32'})
+        points = points[(points[year_field] >= start_year) & (points[year_field] <= end_year)]
+        # Reproject points to match the coordinate system of the raster
+        try:
+            points = points.to_crs(crs_code)
+        except Exception as e:
+            raise Exception(f"Failed to project presence data to {crs_code}.") from e
+        # Filter points to match the extent of the raster
+        return points[points.geometry.within(raster_bbox)]
+
+    def batches():
+        if not use_arrow:
+            yield prepare(gpd.read_file(in_gpkg, layer=in_points, engine='pyogrio',
+                                        columns=columns, where=where, bbox=bbox))
+            return
+        with pyogrio.open_arrow(in_gpkg, layer=in_points, columns=columns, where=where,
+                                bbox=bbox, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+            geometry_name = meta['geometry_name'] or 'wkb_geometry'
+
+            def to_points(batch):
+                df = batch.to_pandas()
+                geometry = shapely.from_wkb(df.pop(geometry_name).to_numpy())
+                return gpd.GeoDataFrame(df[columns], geometry=geometry, crs=meta['crs'])
+
+            is_empty = True
+            for batch in reader:
+                is_empty = False
+                yield prepare(to_points(batch))
+            if is_empty:
+                yield prepare(to_points(reader.schema.empty_table()))
+
+    return info['crs'], info['features'], batches()
+
+
+@profiled('thin')
+def thin(in_gpkg, in_points, in_cost, out_gpkg, out_points, out_points_thinned, year_field, start_year, end_year, location_field,
+         writer=None, return_points=False, batch_size=100000):
     """
     Prepares presence data for further processing by projecting it to the cost surface CRS and reducing the
     data to the resolution of the cost surface, retaining the earliest observation per cell.
+    The presence data is read in batches of batch_size rows (see read_point_batches()), so that only the points within
+    the years and the raster extent are held in memory.
+    Layers are saved with the given LayerWriter, if any. With return_points=True, the imported points are returned as
+    well (thinned points, cell size, imported points).
     """
     extent = in_cost.bounds
     xmin, ymin, xmax, ymax = extent.left, extent.bottom, extent.right, extent.top
     cell_size, cell_size_y = in_cost.res
     crs_code = in_cost.crs
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Cost raster has CRS {crs_code} and cell size {cell_size} x {cell_size_y}.")
+    logger.info(f"Cost raster has CRS {crs_code} and cell size {cell_size} x {cell_size_y}.")
 
     # Check if cell size width and height are the same. If not, stop script execution.
     # The thinning process relies on a fishnet with equal cell side length.
@@ -21,60 +144,49 @@ def thin(in_gpkg, in_points, in_cost, out_gpkg, out_points, out_points_thinned,
         raise Exception("Raster cells are required to have equal side lengths for the thinning procedure.")
 
     # Read presence data. Import the columns specified in year_field and location_field only
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Loading presence data from '{in_gpkg}'...")
-    points = gpd.read_file(in_gpkg, layer=in_points, include_fields=[year_field,location_field])
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Presence data has CRS {points.crs} and {len(points.index)} rows, "
-        f"of which {len(points.dropna(subset=[year_field, 'geometry']).index)} rows with non-null year and geometry.")
-    points = points.dropna(subset=[year_field, 'geometry']).astype({year_field: 'int32'})
-    points = points[(points[year_field] >= start_year) & (points[year_field] <= end_year)]
-
-    # Sample 80% of the data randomly (tbd - for testing - remove later?)
-    # sample_fraction = 0.8
-    # points = points.sample(frac=sample_fraction, random_state=None)
-    # print(f"[{dt.now().strftime('%H:%M:%S')}] Randomly sampled {sample_fraction * 100}% of points, resulting in {len(points.index)} rows.")
-
-    # Reproject points to match the coordinate system of the raster
-    try:
-        points = points.to_crs(crs_code)
-        print(f"[{dt.now().strftime('%H:%M:%S')}] Projected presence data to {crs_code}.")
-    except Exception as e:
-        raise Exception(f"[{dt.now().strftime('%H:%M:%S')}] Failed to project presence data to {crs_code}.") from e
+    logger.info(f"Loading presence data from '{in_gpkg}'...")
+    points_crs, row_count, point_batches = read_point_batches(
+        in_gpkg, in_points, year_field, location_field, start_year, end_year, crs_code, extent, batch_size)
+    logger.info(f"Presence data has CRS {points_crs} and {row_count} rows.")
 
-    # Filter points to match the extent of the raster
-    raster_bbox = box(xmin, ymin, xmax, ymax)
-    points = points[points.geometry.within(raster_bbox)]
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Applied filter to include presence data within raster extent only.")
-
-    # Save the imported points to the GeoPackage which is specific to the script run
-    points.to_file(out_gpkg, layer=out_points)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Imported presence data saved to '{out_gpkg}', layer '{out_points}'.")
-
-    # Create a temporary fishnet based on the raster properties
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Creating temporary fishnet with raster properties...")
+    # Assign points to the cells of a fishnet with the raster properties, batch by batch. Only the fishnet edges are
+    # built, not the polygons, so memory depends on the number of points rather than the number of cells.
     x_range = np.arange(xmin, xmax, cell_size)
     y_range = np.arange(ymin, ymax, cell_size)
+    batches, batch_positions, batch_cell_ids = [], [], []
+    point_count = 0
+    for batch in point_batches:
+        positions, cell_ids = fishnet_cells(batch.geometry.x.to_numpy(), batch.geometry.y.to_numpy(), x_range, y_range,
+                                            cell_size)
+        batches.append(batch)
+        batch_positions.append(positions + point_count)
+        batch_cell_ids.append(cell_ids)
+        point_count += len(batch.index)
+    points = pd.concat(batches, ignore_index=True) if len(batches) > 1 else batches[0].reset_index(drop=True)
+    point_positions, cell_ids = np.concatenate(batch_positions), np.concatenate(batch_cell_ids)
+    logger.info(f"Projected presence data to {crs_code} and assigned {len(points.index)} observations with "
+                f"non-null year and geometry within the years and the raster extent to fishnet cells.")
 
-    fishnet = gpd.GeoDataFrame(geometry=[Polygon([
-        (x, y), (x + cell_size, y), (x + cell_size, y + cell_size), (x, y + cell_size)
-    ]) for x in x_range for y in y_range])
-
-    fishnet.set_crs(crs_code, inplace=True)
+    # Save the imported points to the GeoPackage which is specific to the script run
+    save_layer(points, out_gpkg, out_points,
+               f"Imported presence data saved to '{out_gpkg}', layer '{out_points}'.", writer)
 
-    # Join points with fishnet cells
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Joining observations and fishnet polygons...")
-    thinned = gpd.sjoin(points, fishnet, how="inner", predicate="intersects")
+    # Select the point with the minimum year in each fishnet cell
+    logger.info("Selecting earliest observation per fishnet cell...")
+    thinned = points.iloc[earliest_per_cell(point_positions, cell_ids, points[year_field].to_numpy())]
+    thinned = thinned.reset_index(drop=True)
 
-    # Group points by fishnet cell and select the point with the minimum year in each group
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Selecting earliest observation per fishnet polygon...")
-    thinned = thinned.groupby("index_right").apply(lambda group: group.loc[group[year_field].idxmin()])
+    # Number the thinned points. The least-cost paths refer to their source and destination points by this ID.
+    thinned.insert(0, 'point_id', np.arange(len(thinned)))
 
-    # Drop index and reset CRS (CRS information gets lost during sjoin or groupby)
-    thinned.reset_index(drop=True, inplace=True)
-    thinned.drop(columns=['index_right'], inplace=True)
-    thinned.set_crs(crs_code, inplace=True)
+    # Store the raster cell (row, col) of each thinned point, so that later steps need not look it up point by point
+    thinned['raster_row'], thinned['raster_col'] = rio.transform.rowcol(
+        in_cost.transform, thinned.geometry.x.to_numpy(), thinned.geometry.y.to_numpy())
 
     # Save the thinned points to the GeoPackage which is specific to the script run
-    thinned.to_file(out_gpkg, layer=out_points_thinned)
-    print(f"[{dt.now().strftime('%H:%M:%S')}] Thinned imported presence data saved to '{out_gpkg}', layer '{out_points_thinned}'.")
+    save_layer(thinned, out_gpkg, out_points_thinned,
+               f"Thinned imported presence data saved to '{out_gpkg}', layer '{out_points_thinned}'.", writer)
 
+    if return_points:
+        return thinned, cell_size, points
     return thinned, cell_size
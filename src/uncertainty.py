@@ -0,0 +1,257 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from src.thinning import fishnet_cells, earliest_per_cell
+from src.leastcostpaths import paths, read_cost_array, share_cost_array, attach_cost_array
+from src.populations import group_paths, group_points, path_cells
+from src.expansionrate import expansion_rate
+from src.layerio import read_layer, write_table
+from src.profiling import profiler, profiled, stage
+
+logger = logging.getLogger(__name__)
+
+
+class Replicates:
+    """
+    Resampled replicates of a run: the observations (imported points) are subsampled without replacement (method
+    'subsample', a fraction of the points) or bootstrapped (method 'bootstrap', as many points drawn with replacement),
+    and thinning, least-cost paths, grouping and expansion rates are repeated for the resampled points.
+    A replicate only has fewer (or later) earliest observations per cell than the run. Its known points are therefore a
+    subset of those of the run, and a path of the run stays the least-cost path of its destination as long as the
+    destination (cell and year) and the source (cell, with an earlier year) are in the replicate. Only the paths of the
+    other destinations are calculated, destinations without a path in the run stay without a path.
+    The points must be the grouped points of the run (see group_points_save()), the paths those of the run with source
+    and destination cells (see leastcostpaths.paths()).
+    """
+
+    def __init__(self, points, run_paths, in_cost, cost_array, year_field, location_field, start_year, end_year,
+                 threshold, threshold_is_absolute, max_cost=None, window_buffer=None):
+        if path_cells(run_paths) is None:
+            raise ValueError("The least-cost paths have no source and destination cells. Run the analysis again.")
+        self.points = points.reset_index(drop=True)
+        self.in_cost, self.cost_array = in_cost, cost_array
+        self.year_field, self.location_field = year_field, location_field
+        self.start_year, self.end_year = start_year, end_year
+        self.threshold, self.threshold_is_absolute = threshold, threshold_is_absolute
+        self.max_cost, self.window_buffer = max_cost, window_buffer
+        self.cell_size = in_cost.res[0]
+        self.years = self.points[year_field].to_numpy(dtype=np.int64)
+
+        # Fishnet cells of all points, like in thin() (sorted by point position), and their raster cells
+        extent = in_cost.bounds
+        x, y = self.points.geometry.x.to_numpy(), self.points.geometry.y.to_numpy()
+        self.fishnet_positions, self.fishnet_cell_ids = fishnet_cells(
+            x, y, np.arange(extent.left, extent.right, self.cell_size),
+            np.arange(extent.bottom, extent.top, self.cell_size), self.cell_size)
+        rows, cols = rio.transform.rowcol(in_cost.transform, x, y)
+        self.raster_rows, self.raster_cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        self.raster_cells = self.raster_rows * in_cost.width + self.raster_cols
+
+        # Paths of the run by destination (cell and year) and source cell
+        self.run_paths = run_paths[['destination_year', 'accumulated_cost', 'source_cell', 'destination_cell',
+                                    'geometry']].reset_index(drop=True)
+        self.path_years = self.run_paths['destination_year'].to_numpy(dtype=np.int64)
+        self.path_keys = self.cell_keys(self.run_paths['destination_cell'].to_numpy(dtype=np.int64), self.path_years)
+        self.path_source_cells = self.run_paths['source_cell'].to_numpy(dtype=np.int64)
+
+        # Destinations of the run without a path (unreachable). With fewer known points, they stay unreachable.
+        thinned = earliest_per_cell(self.fishnet_positions, self.fishnet_cell_ids, self.years)
+        thinned = thinned[self.years[thinned] > start_year]
+        self.no_path_keys = np.setdiff1d(self.cell_keys(self.raster_cells[thinned], self.years[thinned]),
+                                         self.path_keys)
+
+    def cell_keys(self, cells, years):
+        """
+        Returns a key for each combination of raster cell and year.
+        """
+        return cells * (self.end_year - self.start_year + 1) + (years - self.start_year)
+
+    def sample(self, rng, method, fraction):
+        """
+        Returns the positions of the points of a replicate, in their original order.
+        """
+        n = len(self.points.index)
+        if method == 'bootstrap':
+            return np.sort(rng.integers(0, n, size=n))
+        if method == 'subsample':
+            return np.sort(rng.choice(n, size=int(round(fraction * n)), replace=False))
+        raise ValueError(f"Invalid resampling method '{method}'. Valid methods are 'subsample' or 'bootstrap'.")
+
+    def thin(self, positions):
+        """
+        Returns the thinned points of the sampled points (positions), like thin(), and their positions in the sample.
+        """
+        # Fishnet cells of the sampled points, looked up from those of all points
+        starts = np.searchsorted(self.fishnet_positions, positions, side='left')
+        counts = np.searchsorted(self.fishnet_positions, positions, side='right') - starts
+        sample_positions = np.repeat(np.arange(len(positions)), counts)
+        entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        thinned = earliest_per_cell(sample_positions, self.fishnet_cell_ids[entries], self.years[positions])
+
+        thinned_points = self.points.iloc[positions[thinned]][[self.year_field, 'geometry']].reset_index(drop=True)
+        thinned_points.insert(0, 'point_id', np.arange(len(thinned)))
+        thinned_points['raster_row'] = self.raster_rows[positions[thinned]]
+        thinned_points['raster_col'] = self.raster_cols[positions[thinned]]
+        return thinned_points, thinned
+
+    def replicate_paths(self, thinned_points):
+        """
+        Returns the least-cost paths of the thinned points of a replicate, in the order of leastcostpaths.paths(): the
+        paths of the run which are still valid, and the paths of the other destinations. Also returns the number of
+        calculated paths.
+        """
+        years = thinned_points[self.year_field].to_numpy(dtype=np.int64)
+        cells = (thinned_points['raster_row'].to_numpy(dtype=np.int64) * self.in_cost.width
+                 + thinned_points['raster_col'].to_numpy(dtype=np.int64))
+        keys = self.cell_keys(cells, years)
+
+        # Keep the paths of the run whose destination is in the replicate and whose source cell has an earlier point
+        earliest_years = pd.Series(years).groupby(cells).min()
+        source_years = earliest_years.reindex(self.path_source_cells).to_numpy()
+        is_kept = np.isin(self.path_keys, keys) & (source_years < self.path_years)
+        kept = self.run_paths[is_kept]
+
+        # Calculate the paths of the other destinations. Points from the first year of the replicate have no known
+        # points to connect to.
+        first_year = max(years.min(), self.start_year) if len(years) else self.start_year
+        is_destination = ((years > first_year) & ~np.isin(keys, self.path_keys[is_kept])
+                          & ~np.isin(keys, self.no_path_keys))
+        if is_destination.any():
+            calculated = paths(None, None, thinned_points, self.in_cost, self.year_field, self.start_year,
+                               self.end_year, max_cost=self.max_cost, window_buffer=self.window_buffer,
+                               cost_array=self.cost_array, destinations=is_destination)[kept.columns]
+        else:
+            calculated = kept.iloc[:0]
+
+        # Order the paths by year and destination point, like a run on the thinned points
+        first_points = pd.Series(np.arange(len(keys))).groupby(keys).min()
+        destination_points = np.concatenate([
+            first_points.reindex(self.path_keys[is_kept]).to_numpy(dtype=np.int64),
+            first_points.reindex(self.cell_keys(calculated['destination_cell'].to_numpy(dtype=np.int64),
+                                                calculated['destination_year'].to_numpy(dtype=np.int64))).to_numpy(
+                dtype=np.int64)])
+        replicate_paths = pd.concat([kept, calculated], ignore_index=True)
+        order = np.lexsort((destination_points, replicate_paths['destination_year'].to_numpy()))
+        return replicate_paths.iloc[order].reset_index(drop=True), len(calculated.index)
+
+    def run(self, replicate, seed_sequence, method, fraction):
+        """
+        Runs one replicate with the random generator seeded by seed_sequence. Returns the expansion rates of its
+        populations, each matched to the population of the run which most of its points belong to (group_id). Of
+        several populations matched to the same population of the run, the one sharing most points is kept.
+        """
+        with stage('replicate', replicate=replicate):
+            positions = self.sample(np.random.default_rng(seed_sequence), method, fraction)
+            thinned_points, _ = self.thin(positions)
+            replicate_paths, calculated_n = self.replicate_paths(thinned_points)
+            logger.info(f"Replicate {replicate}: {len(replicate_paths.index) - calculated_n} least-cost paths kept "
+                        f"from the run, {calculated_n} calculated.")
+
+            # Group paths and points and calculate expansion rates, like the run
+            costs = replicate_paths['accumulated_cost'].to_numpy()
+            if self.threshold_is_absolute:
+                threshold_as_cost = self.threshold
+            else:
+                threshold_as_cost = np.quantile(costs, self.threshold) if len(costs) else np.inf
+            grouped_paths = group_paths(replicate_paths[costs < threshold_as_cost])
+            points = self.points.iloc[positions][[self.year_field, self.location_field, 'geometry']]
+            grouped_points = group_points(points.reset_index(drop=True), grouped_paths, self.cell_size)
+            _, exp_rates = expansion_rate(grouped_points, self.year_field, self.location_field)
+
+            # Match the populations to those of the run
+            shared = pd.DataFrame({'replicate_group_id': grouped_points['group_id'].to_numpy(),
+                                   'group_id': self.points['group_id'].to_numpy()[positions]}).dropna()
+            shared = shared.value_counts().reset_index(name='shared_points')
+            shared = shared.sort_values(['shared_points', 'group_id'], ascending=[False, True], kind='stable')
+            shared = shared.drop_duplicates('replicate_group_id').drop_duplicates('group_id')
+            rates = shared.merge(exp_rates.rename(columns={'group_id': 'replicate_group_id'}), on='replicate_group_id')
+            rates.insert(0, 'replicate', replicate)
+            return rates[['replicate', 'group_id', 'replicate_group_id', 'shared_points', 'point_count',
+                          'median_points_per_year', 'expansion_rate', 'r2']]
+
+
+# Replicates of a worker process, set up once by _init_worker()
+_worker_replicates = {}
+
+
+def _init_worker(in_gpkg, in_points, in_paths, cost_path, reference, settings):
+    profiler.reset()
+    _worker_replicates['dataset'] = rio.open(cost_path)
+    cost_array, _worker_replicates['shared'] = attach_cost_array(reference)
+    _worker_replicates['replicates'] = Replicates(read_layer(in_gpkg, in_points), read_layer(in_gpkg, in_paths),
+                                                  _worker_replicates['dataset'], cost_array, **settings)
+
+
+def _run_replicates_worker(args):
+    replicates, seed_sequences, method, fraction = args
+    results = [_worker_replicates['replicates'].run(replicate, seed_sequence, method, fraction)
+               for replicate, seed_sequence in zip(replicates, seed_sequences)]
+    # Pass the stages recorded in the worker process on to the main process
+    return results, profiler.take_records()
+
+
+@profiled('uncertainty')
+def expansion_rate_uncertainty(in_gpkg, in_points, in_paths, in_cost, out_replicates, out_summary, year_field,
+                               location_field, start_year, end_year, threshold, threshold_is_absolute,
+                               replicates=100, method='subsample', fraction=0.8, seed=0, confidence=0.95,
+                               max_cost=None, low_memory=False, window_buffer=None, workers=1):
+    """
+    Estimates the uncertainty of the expansion rates of a run from resampled replicates (see Replicates), reading the
+    grouped points (in_points) and least-cost paths of the run from the GeoPackage.
+    Each replicate has its own random generator, spawned from the seed, so the results do not depend on the number of
+    worker processes. With workers > 1, the replicates are distributed to a pool of worker processes, which share the
+    cost array.
+    Saves the expansion rates of all replicates (out_replicates) and, for each population of the run, its expansion
+    rate, the share of replicates in which it was found and the mean, standard deviation and percentile confidence
+    interval of its replicate expansion rates (out_summary). Returns both tables.
+    """
+    logger.info(f"Running {replicates} replicates ({method}) to estimate the uncertainty of the expansion rates...")
+    settings = dict(year_field=year_field, location_field=location_field, start_year=start_year, end_year=end_year,
+                    threshold=threshold, threshold_is_absolute=threshold_is_absolute, max_cost=max_cost,
+                    window_buffer=window_buffer)
+    seed_sequences = np.random.SeedSequence(seed).spawn(replicates)
+    points = read_layer(in_gpkg, in_points)
+
+    cost_array = read_cost_array(in_cost, low_memory)
+    if workers > 1:
+        reference, shared = share_cost_array(cost_array, f"{in_cost.name}.float32.npy" if low_memory else None)
+        del cost_array
+        chunks = [chunk for chunk in np.array_split(np.arange(replicates), workers * 4) if len(chunk)]
+        logger.info(f"Distributing {replicates} replicates to {workers} worker processes...")
+        results = []
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(in_gpkg, in_points, in_paths, in_cost.name, reference,
+                                               settings)) as executor:
+                for chunk_results, chunk_records in executor.map(_run_replicates_worker, [
+                        (chunk, [seed_sequences[i] for i in chunk], method, fraction) for chunk in chunks]):
+                    results += chunk_results
+                    profiler.add_records(chunk_records)
+        finally:
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+    else:
+        engine = Replicates(points, read_layer(in_gpkg, in_paths), in_cost, cost_array, **settings)
+        results = [engine.run(replicate, seed_sequence, method, fraction)
+                   for replicate, seed_sequence in enumerate(seed_sequences)]
+
+    replicate_rates = pd.concat(results, ignore_index=True)
+    write_table(replicate_rates, out_replicates)
+    logger.info(f"Expansion rates of the replicates saved to '{out_replicates}'.")
+
+    # Distribution of the replicate expansion rates of each population of the run
+    _, exp_rates = expansion_rate(points, year_field, location_field)
+    alpha = (1 - confidence) / 2
+    distribution = replicate_rates.groupby('group_id')['expansion_rate'].agg(
+        replicates='count', rate_mean='mean', rate_std='std',
+        rate_ci_low=lambda rates: rates.quantile(alpha), rate_ci_high=lambda rates: rates.quantile(1 - alpha))
+    summary = exp_rates[['group_id', 'point_count', 'expansion_rate']].merge(
+        distribution, how='left', left_on='group_id', right_index=True)
+    summary['replicates'] = summary['replicates'].fillna(0).astype(np.int64)
+    summary.insert(4, 'found_share', summary['replicates'] / replicates)
+    write_table(summary, out_summary)
+    logger.info(f"Expansion rate uncertainty ({confidence:.0%} confidence intervals) saved to '{out_summary}'.")
+    return replicate_rates, summary